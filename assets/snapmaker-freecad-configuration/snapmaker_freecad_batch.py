@@ -0,0 +1,207 @@
+'''Headless batch post-processing of FreeCAD Path jobs for Snapmaker 2.
+
+Posts the jobs of many .FCStd documents in parallel, one FreeCAD instance
+per worker process, without touching the GUI. Run it with the Python
+interpreter that ships with FreeCAD, or point --freecad-lib to FreeCAD's lib
+directory:
+
+    python snapmaker_freecad_batch.py --workers 4 --summary timing.csv \\
+        part1.FCStd part2.FCStd:Job001
+
+A document given as <file>:<job label> only posts that job, otherwise all
+jobs of the document are posted. Output files are named
+<document>-<job label>.cnc next to the document or in --output-dir. Like
+FreeCAD's post command, every fixture of a job is posted with the
+operations, each after its tool controller when the tool changes.
+'''
+import argparse
+import concurrent.futures
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+SUMMARY_COLUMNS = ["document", "job", "output", "operations", "lines", "bytes", "open_s", "post_s", "error"]
+
+# set in every worker process by initWorker()
+FreeCAD = None
+Path = None
+post = None
+
+
+def initWorker(freecadLib):
+    global FreeCAD
+    global Path
+    global post
+    if freecadLib:
+        sys.path.insert(0, freecadLib)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import FreeCAD as freecadModule
+    import Path as pathModule
+    import snapmaker_freecad_post
+    FreeCAD = freecadModule
+    Path = pathModule
+    post = snapmaker_freecad_post
+
+
+def splitSpec(spec):
+    '''Splits "<document>[:<job label>]", keeping drive letters intact.'''
+    head, sep, tail = spec.rpartition(':')
+    if sep and head.lower().endswith('.fcstd'):
+        return head, tail
+    return spec, None
+
+
+def isJob(obj):
+    return hasattr(obj, "Operations") and hasattr(obj, "PostProcessor")
+
+
+class Fixture:
+    '''The object FreeCAD's post command posts for a fixture: its G54..G59, and a retract after the first one.'''
+
+    def __init__(self, job, path):
+        self.Name = self.Label = "Fixture"
+        self.Path = path
+        self.InList = [job]
+
+
+def toolController(op):
+    '''The tool controller of an operation or of the base of a dressup.'''
+    tc = getattr(op, "ToolController", None)
+    if tc is None and hasattr(op, "Base"):
+        tc = getattr(op.Base, "ToolController", None)
+    return tc
+
+
+def postList(job, operations):
+    '''Objects to post for the operations of the job, in the order of FreeCAD's post command.
+
+    Every fixture is followed by the operations, each after its tool
+    controller when the tool changes, so the output has the M6 and M3 of
+    the tool controllers like when posting in the GUI.
+    '''
+    objects = []
+    currentTool = None
+    for index, fixture in enumerate(job.Fixtures):
+        commands = [Path.Command(fixture)]
+        if index != 0:
+            clearance = job.Stock.Shape.BoundBox.ZMax + job.SetupSheet.ClearanceHeightOffset.Value
+            commands.append(Path.Command("G0", {"Z": clearance}))
+        objects.append(Fixture(job, Path.Path(commands)))
+        for op in operations:
+            tc = toolController(op)
+            if tc is not None and getattr(op, "Active", True):
+                if tc.ToolNumber != currentTool:
+                    objects.append(tc)
+                    currentTool = tc.ToolNumber
+            objects.append(op)
+    return objects
+
+
+def countLines(filename):
+    lines = 0
+    with open(filename, "rb") as gfile:
+        for block in iter(lambda: gfile.read(1 << 20), b""):
+            lines += block.count(b"\n")
+    return lines
+
+
+def postDocument(documentPath, jobLabel, outputDir, argstring, operationLabels=None):
+    '''Posts the jobs of one document. Returns one summary row per job.
+
+    With operationLabels only the operations with these labels are posted.
+    '''
+    rows = []
+    started = time.perf_counter()
+    try:
+        doc = FreeCAD.openDocument(documentPath)
+    except Exception as e:  # pylint: disable=broad-except
+        return [dict(document=documentPath, job=jobLabel or "", error="cannot open: %s" % e)]
+    opened = time.perf_counter() - started
+
+    try:
+        jobs = [obj for obj in doc.Objects if isJob(obj) and (jobLabel is None or obj.Label == jobLabel)]
+        if not jobs:
+            rows.append(dict(document=documentPath, job=jobLabel or "", open_s=round(opened, 3), error="no such job"))
+        for job in jobs:
+            base = os.path.splitext(os.path.basename(documentPath))[0]
+            directory = outputDir or os.path.dirname(os.path.abspath(documentPath))
+            filename = os.path.join(directory, "%s-%s.cnc" % (base, job.Label))
+            operations = list(job.Operations.Group)
+            if operationLabels is not None:
+                operations = [op for op in operations if op.Label in operationLabels]
+            args = argstring
+            if args is None:
+                args = getattr(job, "PostProcessorArgs", "") or ""
+
+            row = dict(document=documentPath, job=job.Label, output=filename, operations=len(operations), open_s=round(opened, 3))
+            missing = set(operationLabels or ()) - set(op.Label for op in operations)
+            if missing:
+                row["error"] = "no such operation: %s" % ", ".join(sorted(missing))
+                rows.append(row)
+                continue
+            started = time.perf_counter()
+            try:
+                if post.export(postList(job, operations), filename, args) is None:
+                    row["error"] = "post processor failed"
+                else:
+                    row["lines"] = countLines(filename)
+                    row["bytes"] = os.path.getsize(filename)
+            except Exception as e:  # pylint: disable=broad-except
+                row["error"] = "%s: %s" % (type(e).__name__, e)
+            row["post_s"] = round(time.perf_counter() - started, 3)
+            rows.append(row)
+    finally:
+        FreeCAD.closeDocument(doc.Name)
+    return rows
+
+
+def printSummary(rows):
+    widths = [max(len(column), *(len(str(row.get(column, ""))) for row in rows)) for column in SUMMARY_COLUMNS]
+    print("  ".join(column.ljust(width) for column, width in zip(SUMMARY_COLUMNS, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(column, "")).ljust(width) for column, width in zip(SUMMARY_COLUMNS, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='snapmaker_freecad_batch', description='post-process FreeCAD Path jobs without the GUI')
+    parser.add_argument('documents', nargs='+', help='FreeCAD documents, optionally as <file>:<job label>')
+    parser.add_argument('--args', help='post processor arguments, default: the PostProcessorArgs of each job')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes, default: number of CPUs')
+    parser.add_argument('--output-dir', help='directory for the .cnc files, default: next to each document')
+    parser.add_argument('--summary', help='write the per-job timing summary to this CSV file')
+    parser.add_argument('--freecad-lib', help='directory containing FreeCAD.so/FreeCAD.pyd if not on the Python path')
+    args = parser.parse_args(argv)
+
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    started = time.perf_counter()
+    rows = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max(args.workers, 1),
+                                                mp_context=multiprocessing.get_context('spawn'),
+                                                initializer=initWorker,
+                                                initargs=(args.freecad_lib,)) as pool:
+        futures = []
+        for spec in args.documents:
+            documentPath, jobLabel = splitSpec(spec)
+            futures.append(pool.submit(postDocument, os.path.abspath(documentPath), jobLabel, args.output_dir, args.args))
+        for future in futures:
+            rows.extend(future.result())
+
+    printSummary(rows)
+    failed = [row for row in rows if row.get("error")]
+    print("posted %d job(s), %d failed, %.1f s" % (len(rows) - len(failed), len(failed), time.perf_counter() - started))
+
+    if args.summary:
+        with open(args.summary, "w", newline="") as summaryFile:
+            writer = csv.DictWriter(summaryFile, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
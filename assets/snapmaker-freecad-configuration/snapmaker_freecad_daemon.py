@@ -0,0 +1,334 @@
+'''Local posting service for FreeCAD Path jobs, keeping FreeCAD and the post loaded.
+
+Starting FreeCAD and importing the post takes seconds, far longer than
+posting a small job. The service starts its worker processes once, each
+with FreeCAD and snapmaker_freecad_post imported (see
+snapmaker_freecad_batch.py), and posts the jobs sent to it over HTTP on
+localhost, --workers at a time with up to --queue more waiting:
+
+    python snapmaker_freecad_daemon.py --workers 2 --port 8765
+
+A job is posted as JSON to /post, the reply comes once it is done:
+
+    curl -d '{"document": "/work/part.FCStd", "job": "Job", "operations": ["Profile"]}' \\
+        http://127.0.0.1:8765/post
+
+or with this script as client:
+
+    python snapmaker_freecad_daemon.py --submit /work/part.FCStd:Job --operations Profile
+
+A job has a document, optionally the job label (default: all jobs), the
+operation labels (default: all), the post processor args (default: the
+PostProcessorArgs of the job) and output_dir (default: next to the
+document). The reply has the summary rows of snapmaker_freecad_batch.py with
+the output file, lines, bytes and timings, plus the seconds the job waited
+in the queue. GET /status reports the workers and the queue. Jobs beyond
+the queue are refused with 503, a job that fails in the service is answered
+with 500 and the error.
+
+The service has no authentication, so it only listens on a loopback
+address unless started with --allow-remote. The args of a job may only
+hold the post options in POST_OPTIONS, none of which writes files, and
+output_dir must lie in the directory of the document or in one of the
+--output-root directories.
+'''
+import argparse
+import concurrent.futures
+import http.client
+import http.server
+import json
+import multiprocessing
+import ipaddress
+import os
+import shlex
+import socket
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import snapmaker_freecad_batch
+
+DEFAULT_PORT = 8765
+QUEUE_SIZE = 16  # jobs waiting for a worker before new ones are refused
+JOB_FIELDS = {"document": str, "job": str, "operations": list, "args": str, "output_dir": str}
+# post options a job may give, --profile-json and --toolpath are left out as they write files
+POST_OPTIONS = frozenset([
+    "--no-header", "--no-comments", "--line-numbers", "--no-show-editor", "--precision", "--trim-zeros",
+    "--segments", "--chord-tolerance", "--simplify", "--estimate-acceleration", "--threads", "--order-holes",
+    "--rapids", "--jog-speed", "--order-contours", "--profile", "--max-feed", "--work-origin", "--strict",
+    "--no-cache", "--thumbnail-size", "--no-thumbnail", "--break-straight", "--preamble", "--postamble",
+    "--inches", "--modal", "--axis-modal", "--no-tlo", "--leveltwocnc",
+])
+
+
+class QueueFull(Exception):
+    pass
+
+
+def workerReady():
+    return os.getpid()
+
+
+def runJob(job, submitted):
+    '''Posts a job in a worker process, see snapmaker_freecad_batch.postDocument().'''
+    waited = time.time() - submitted
+    if job.get("output_dir"):
+        os.makedirs(job["output_dir"], exist_ok=True)
+    rows = snapmaker_freecad_batch.postDocument(job["document"], job.get("job"), job.get("output_dir"),
+                                                job.get("args"), job.get("operations"))
+    for row in rows:
+        row["queued_s"] = round(waited, 3)
+    return rows
+
+
+def checkPostArgs(argstring):
+    '''Raises ValueError unless the post processor args only hold options of POST_OPTIONS.'''
+    try:
+        words = shlex.split(argstring)
+    except ValueError as e:
+        raise ValueError("args: %s" % e)
+    for word in words:
+        # the post's parser would also take abbreviations, so names must match exactly
+        if word.startswith("--") and word.split("=", 1)[0] not in POST_OPTIONS:
+            raise ValueError("args: %s is not allowed" % word.split("=", 1)[0])
+
+
+def isInside(path, directory):
+    '''True if path is directory or below it, after resolving symbolic links.'''
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def parseJob(request, outputRoots=()):
+    '''Checks the fields of a job request. Raises ValueError if it is invalid.
+
+    The output directory must be in the document's directory or in one of the outputRoots.
+    '''
+    if not isinstance(request, dict):
+        raise ValueError("a job must be a JSON object")
+    for field, value in request.items():
+        if field not in JOB_FIELDS:
+            raise ValueError("unknown field: %s" % field)
+        if value is not None and not isinstance(value, JOB_FIELDS[field]):
+            raise ValueError("%s must be a %s" % (field, JOB_FIELDS[field].__name__))
+    if not request.get("document"):
+        raise ValueError("document missing")
+    if not all(isinstance(label, str) for label in request.get("operations") or ()):
+        raise ValueError("operations must be labels")
+    if request.get("args"):
+        checkPostArgs(request["args"])
+    job = dict(request)
+    job["document"] = os.path.abspath(job["document"])
+    if job.get("output_dir"):
+        job["output_dir"] = os.path.abspath(job["output_dir"])
+        roots = [os.path.dirname(job["document"])] + list(outputRoots)
+        if not any(isInside(job["output_dir"], root) for root in roots):
+            raise ValueError("output_dir must be in the directory of the document or in an --output-root")
+    return job
+
+
+def isLoopback(host):
+    '''True if every address the host resolves to is a loopback address.'''
+    try:
+        addresses = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(ipaddress.ip_address(address[4][0].split('%')[0]).is_loopback for address in addresses)
+
+
+class PostingService:
+    '''Warm worker processes and the bounded queue of jobs in front of them.'''
+
+    def __init__(self, workers, queueSize=QUEUE_SIZE, freecadLib=None):
+        self.workers = max(workers, 1)
+        self.freecadLib = freecadLib
+        self.pool = self.startPool()
+        self.slots = threading.BoundedSemaphore(self.workers + max(queueSize, 0))
+        self.lock = threading.Lock()
+        self.counts = dict(pending=0, posted=0, failed=0, refused=0, restarts=0)
+
+    def startPool(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers,
+                                                      mp_context=multiprocessing.get_context('spawn'),
+                                                      initializer=snapmaker_freecad_batch.initWorker,
+                                                      initargs=(self.freecadLib,))
+
+    def restart(self, broken):
+        '''Replaces the broken pool of workers, unless another job already did.'''
+        with self.lock:
+            if self.pool is not broken:
+                return
+            self.pool = self.startPool()
+            self.counts["restarts"] += 1
+        broken.shutdown(wait=False)
+
+    def warm(self):
+        '''Starts all workers, FreeCAD and the post are imported when this returns.'''
+        futures = [self.pool.submit(workerReady) for _ in range(self.workers)]
+        return [future.result() for future in futures]
+
+    def post(self, job):
+        '''Posts the job, returns its summary rows. Raises QueueFull if too many jobs wait.
+
+        Errors of the job, e.g. an output_dir that cannot be created, are
+        raised. If a worker died the pool is restarted for the next jobs.
+        '''
+        if not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.counts["refused"] += 1
+            raise QueueFull()
+        with self.lock:
+            self.counts["pending"] += 1
+        pool = self.pool
+        try:
+            rows = pool.submit(runJob, job, time.time()).result()
+        except Exception as e:
+            with self.lock:
+                self.counts["failed"] += 1
+            if isinstance(e, concurrent.futures.BrokenExecutor):
+                self.restart(pool)
+            raise
+        finally:
+            self.slots.release()
+            with self.lock:
+                self.counts["pending"] -= 1
+        with self.lock:
+            for row in rows:
+                self.counts["failed" if row.get("error") else "posted"] += 1
+        return rows
+
+    def status(self):
+        with self.lock:
+            status = dict(self.counts)
+        status["workers"] = self.workers
+        return status
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    '''GET /status and POST /post of the PostingService in server.service.'''
+
+    def do_GET(self):
+        if self.path != "/status":
+            self.reply(404, {"error": "not found"})
+            return
+        self.reply(200, self.server.service.status())
+
+    def do_POST(self):
+        if self.path != "/post":
+            self.reply(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = parseJob(json.loads(self.rfile.read(length).decode('utf-8')), self.server.outputRoots)
+        except ValueError as e:
+            self.reply(400, {"error": str(e)})
+            return
+        started = time.perf_counter()
+        try:
+            rows = self.server.service.post(job)
+        except QueueFull:
+            self.reply(503, {"error": "queue full"})
+            return
+        except Exception as e:
+            self.reply(500, {"error": "%s: %s" % (type(e).__name__, e)})
+            return
+        self.reply(200, {"rows": rows, "seconds": round(time.perf_counter() - started, 3)})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def serve(service, host, port, verbose=False, outputRoots=()):
+    '''Serves the PostingService until interrupted.'''
+    server = http.server.ThreadingHTTPServer((host, port), ServiceHandler)
+    server.daemon_threads = True
+    server.service = service
+    server.verbose = verbose
+    server.outputRoots = [os.path.abspath(root) for root in outputRoots]
+    print("posting service on http://%s:%d, %d worker(s)" % (host, server.server_address[1], service.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def submit(url, job, timeout=None):
+    '''Posts a job to a running service, returns its reply.'''
+    request = urllib.request.Request(url.rstrip('/') + "/post", data=json.dumps(job).encode('utf-8'),
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as reply:
+            return json.loads(reply.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        return json.loads(e.read().decode('utf-8'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='snapmaker_freecad_daemon', description='post FreeCAD Path jobs from a local service with FreeCAD kept loaded')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes, default: number of CPUs')
+    parser.add_argument('--queue', type=int, default=QUEUE_SIZE, help='jobs waiting for a worker before new ones are refused, default: %d' % QUEUE_SIZE)
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on, default: 127.0.0.1')
+    parser.add_argument('--allow-remote', action='store_true', help='allow a --host that is not a loopback address; the service has no authentication')
+    parser.add_argument('--output-root', action='append', default=[], help='directory jobs may also write their output_dir in, can be repeated')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on, default: %d' % DEFAULT_PORT)
+    parser.add_argument('--freecad-lib', help='directory containing FreeCAD.so/FreeCAD.pyd if not on the Python path')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    parser.add_argument('--submit', metavar='DOCUMENT', help='post <file>[:<job label>] with a running service instead of serving')
+    parser.add_argument('--operations', nargs='+', help='with --submit: labels of the operations to post, default: all')
+    parser.add_argument('--args', help='with --submit: post processor arguments, default: the PostProcessorArgs of the job')
+    parser.add_argument('--output-dir', help='with --submit: directory for the .cnc file, in the document\'s directory or an --output-root of the service, default: next to the document')
+    parser.add_argument('--url', help='with --submit: address of the service, default: http://127.0.0.1:<port>')
+    args = parser.parse_args(argv)
+
+    if args.submit:
+        documentPath, jobLabel = snapmaker_freecad_batch.splitSpec(args.submit)
+        job = dict(document=os.path.abspath(documentPath), job=jobLabel, operations=args.operations, args=args.args,
+                   output_dir=args.output_dir and os.path.abspath(args.output_dir))
+        try:
+            reply = submit(args.url or "http://127.0.0.1:%d" % args.port, job)
+        except urllib.error.URLError as e:
+            print("cannot reach the posting service: %s" % e.reason)
+            return 1
+        except (http.client.HTTPException, OSError) as e:
+            print("no reply from the posting service: %s" % (str(e) or type(e).__name__))
+            return 1
+        if "error" in reply:
+            print("failed: %s" % reply["error"])
+            return 1
+        snapmaker_freecad_batch.printSummary(reply["rows"])
+        print("posted in %.3f s" % reply["seconds"])
+        return 1 if any(row.get("error") for row in reply["rows"]) else 0
+
+    if not args.allow_remote and not isLoopback(args.host):
+        print("refusing to listen on %s, not a loopback address; use --allow-remote to do so anyway" % args.host)
+        return 1
+    service = PostingService(args.workers, args.queue, args.freecad_lib)
+    try:
+        started = time.perf_counter()
+        service.warm()
+        print("%d worker(s) ready in %.1f s" % (service.workers, time.perf_counter() - started))
+        serve(service, args.host, args.port, args.verbose, args.output_root)
+    finally:
+        service.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
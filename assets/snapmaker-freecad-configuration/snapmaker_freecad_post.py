@@ -33,6 +33,21 @@ import Path.Log as PathLog
 import Path.Geom as PathGeom
 import math
 import base64
+import collections
+import concurrent.futures
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+import zlib
+import numpy as np
 print("successfully imported FreeCAD modules")
 
 LOG_MODULE = PathLog.thisModule()
@@ -49,15 +64,31 @@ import linuxcnc_post
 linuxcnc_post.export(object,"/path/to/file.ncc","")
 '''
 
-now = datetime.datetime.now()
-
 parser = argparse.ArgumentParser(prog='snapmaker_freecad', add_help=False)
 parser.add_argument('--no-header', action='store_true', help='suppress header output')
 parser.add_argument('--no-comments', action='store_true', help='suppress comment output')
 parser.add_argument('--line-numbers', action='store_true', help='prefix with line numbers')
 parser.add_argument('--no-show-editor', action='store_true', help='don\'t pop up editor before writing output')
-parser.add_argument('--precision', default='3', help='number of digits of precision, default=3')
-parser.add_argument('--segments', default='10', help='segments in curved paths: segs/cm, default=40')
+parser.add_argument('--precision', help='number of digits of precision, default=3')
+parser.add_argument('--trim-zeros', action='store_true', help='drop trailing zeros of coordinates and feedrates, e.g. X10 instead of X10.000')
+parser.add_argument('--segments', help='segments in curved paths: segs/cm, default=10')
+parser.add_argument('--chord-tolerance', help='split arcs by the maximum deviation (sagitta) of a segment from the arc instead of --segments, e.g. 0.002')
+parser.add_argument('--simplify', help='drop duplicate points and merge nearly collinear segments within this tolerance (Ramer-Douglas-Peucker)')
+parser.add_argument('--estimate-acceleration', action='store_true', help='estimate the machining time with a trapezoidal acceleration model instead of length/feedrate only')
+parser.add_argument('--threads', help='number of worker processes generating operations in parallel, default=1')
+parser.add_argument('--order-holes', action='store_true', help='reorder the holes of drilling operations to shorten the travel between them')
+parser.add_argument('--rapids', action='store_true', help='output rapid moves as G0 at the jog speed instead of G1 at the cutting feedrate')
+parser.add_argument('--jog-speed', default='3000', help='feedrate of rapid moves with --rapids, default=3000 (as Luban)')
+parser.add_argument('--order-contours', action='store_true', help='reorder the contours cut at the same depth within an operation to shorten the travel between them')
+parser.add_argument('--profile', action='store_true', help='print the time spent in every posting stage and the number of commands, moves and lines')
+parser.add_argument('--profile-json', help='write the posting stage times and counters to this JSON file')
+parser.add_argument('--max-feed', help='report feedrates above this (mm/min) as violations, default: no limit')
+parser.add_argument('--work-origin', help='machine position X,Y,Z of the work origin, moves outside the machine envelope are reported as violations')
+parser.add_argument('--strict', action='store_true', help='stop posting at the first violation of the machine envelope, --max-feed or the spindle speeds of the toolhead')
+parser.add_argument('--toolpath', help='also write the emitted toolpath as (command, x, y, z, f) records to this .npy file, its other output to <name>.text.npy; emitToolpath() formats it again')
+parser.add_argument('--no-cache', action='store_true', help='post every operation again instead of reusing the cached output of unchanged operations')
+parser.add_argument('--thumbnail-size', default='360x240', help='size of the toolpath preview in the header, default=360x240')
+parser.add_argument('--no-thumbnail', action='store_true', help='suppress the toolpath preview in the header')
 parser.add_argument('--break-straight', action='store_true', help='breaks also straight paths same resolution as in curved paths')
 parser.add_argument('--preamble', help='set commands to be issued before the first command, default="G17\nG90"')
 parser.add_argument('--postamble', help='set commands to be issued after the last command, default="M05\nG17 G90\nM2"')
@@ -82,17 +113,6 @@ CMD_HOLE_SIMPLE       = 'G81'
 CMD_HOLE_DWELL        = 'G82' 
 CMD_HOLE_PECKED       = 'G83' 
 
-MOVE_COMMANDS = [ #this is a hoorrrriiibbleee way of doing it but i dont care:D
-    CMD_MOVE_LINEAR_RAPID +" ",
-    CMD_MOVE_LINEAR + " ",
-    CMD_MOVE_ARC_CW + " ",
-    CMD_MOVE_ARC_CCW + " ",
-    CMD_MOVE_BEZIER + " ",
-    CMD_HOLE_SIMPLE + " ",
-    CMD_HOLE_DWELL + " ",
-    CMD_HOLE_PECKED + " "       
-]
-
 # Param: Movement
 P_POSITION_X = 'X'
 P_POSITION_Y = 'Y'
@@ -117,6 +137,7 @@ class SMCNC:
     minSpindlePower = 50
     maxSpindleRPM = 12000
     maxSpindlePower = 100
+    handlers = {}  # command name -> parse handler replacing the one of COMMAND_HANDLERS
 
 class ARCNC:
     header = "levelTwoCNCToolheadForSM2"
@@ -124,11 +145,14 @@ class ARCNC:
     minSpindlePower = 0
     maxSpindleRPM = 18000
     maxSpindlePower = 100
+    handlers = {}
 
 
 # =============================================================================
 moveDrillInRetractHeight = False
 holeRetractionFactor = 10 # vertical feedrate factor on retract. To speed up retraction make factor > 1
+HOLE_2OPT_LIMIT = 5000 # larger runs of holes are only ordered nearest neighbour first
+HOLE_2OPT_PASSES = 20
 
 # =============================================================================
 # Default move speeds if nothing else is set
@@ -138,10 +162,18 @@ feedrateVertical = 300
 # Commands that are not supported by Marlin (movement is simulated)
 commandsToSimulate = [CMD_HOLE_SIMPLE, CMD_HOLE_PECKED, CMD_HOLE_DWELL]
 commandsToConvert = [CMD_MOVE_ARC_CW, CMD_MOVE_ARC_CCW, CMD_MOVE_LINEAR_RAPID, CMD_MOVE_LINEAR, CMD_MOVE_BEZIER]
+# Commands discretized by the batched NumPy engine, everything else in
+# commandsToConvert (G5) falls back to the FreeCAD edge discretization
+commandsStraight = [CMD_MOVE_LINEAR_RAPID, "G00", CMD_MOVE_LINEAR, "G01"]
+commandsRapid = [CMD_MOVE_LINEAR_RAPID, "G00"]
+commandsArcCW = [CMD_MOVE_ARC_CW, "G02"]
+commandsArcCCW = [CMD_MOVE_ARC_CCW, "G03"]
+commandsHoles = frozenset(commandsToSimulate)
 
 # =============================================================================
 
-# These globals set common customization preferences
+# These globals set common customization preferences, they are the defaults
+# of every SnapmakerPost and are never changed by posting
 OUTPUT_COMMENTS = True
 OUTPUT_HEADER = True
 OUTPUT_LINE_NUMBERS = False
@@ -151,9 +183,14 @@ USE_TLO = True # if true G43 will be output following tool changes
 OUTPUT_DOUBLES = True  # if false duplicate axis values are suppressed if the same as previous line.
 COMMAND_SPACE = " "
 
-LINENR = 100  # line number starting value
-SEGMENTS_PER_CM_ARC = 40 # Numbers of segments an arc should be broken into within 1cm of arc distance
+LINENR = 100  # line number starting value, every export starts here again
+SEGMENTS_PER_CM_ARC = 10 # Numbers of segments an arc should be broken into within 1cm of arc distance
 BREAK_STRAIGHTS = False # When True, straight lines will be broken into subsegments as curved paths
+CHORD_TOLERANCE = None # When set, arcs are split so no segment deviates more than this from the arc
+MAX_CHORD_ANGLE = math.pi / 2 # upper bound for the angle of a single arc segment in chord tolerance mode
+SIMPLIFY_TOLERANCE = None # When set, moves deviating less than this from a straight path are merged
+THREADS = 1 # Operations generated in parallel, output is still written in order
+TRIM_ZEROS = False # When True, trailing zeros of X, Y, Z and F values are dropped (X10 instead of X10.000)
 
 # These globals will be reflected in the Machine configuration of the project
 UNITS = "G21"  # G21 for metric, G20 for us standard
@@ -163,8 +200,19 @@ UNIT_FORMAT = 'mm'
 MACHINE_NAME = "Snapmaker"
 CORNER_MIN = {'x': 0, 'y': 0, 'z': 0}
 CORNER_MAX = {'x': 500, 'y': 300, 'z': 300}
+MAX_FEEDRATE = None # mm/min, higher feedrates are violations (--max-feed)
+VIOLATIONS_REPORTED = 20 # violations listed per export, all of them are counted
 PRECISION = 3
 
+# Approximate axis accelerations (mm/s^2) used by --estimate-acceleration
+MAX_ACCELERATION = {'x': 1000, 'y': 1000, 'z': 100}
+ESTIMATE_ACCELERATION = False
+
+# Header fields that depend on the whole program, patched in after emission
+BOUNDARY_FIELDS = ["max_x(mm)", "max_y(mm)", "max_z(mm)", "max_b(mm)", "min_x(mm)", "min_y(mm)", "min_b(mm)", "min_z(mm)"]
+HEADER_FIELDS = ["file_total_lines", "estimated_time(s)"] + BOUNDARY_FIELDS
+HEADER_FIELD_WIDTH = 16
+
 # Preamble text will appear at the beginning of the GCODE output file.
 PREAMBLE = '''G17 G54 G40 G49 G80 G90'''
 
@@ -179,16 +227,842 @@ POST_OPERATION = ''''''
 # Tool Change commands will be inserted before a tool change
 TOOL_CHANGE = ''''''
 
-currentHeadPosition = FreeCAD.Vector(0,0,0)
+# Head position every export starts from
+START_POSITION = FreeCAD.Vector(0,0,0)
+# the move up the header makes before the first operation
+PREAMBLE_Z = 10.0
+PREAMBLE_FEEDRATE = 300
 
-TOOLHEAD = None
+TOOLHEAD = None # toolhead class, None selects it by --leveltwocnc
 
 # to distinguish python built-in open function from the one declared below
 if open.__module__ in ['__builtin__','io']:
     pythonopen = open
 
-def log(msg):
-    PathLog.debug(msg)
+# characters of output buffered before they are flushed to the target, a
+# single write can hold a whole batch of moves
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Toolpath previews are cached here by a hash of the toolpath and options,
+# least recently used entries are removed above THUMBNAIL_CACHE_SIZE bytes
+THUMBNAIL_CACHE_DIR = os.path.join(getattr(FreeCAD, "getUserCachePath", tempfile.gettempdir)(), "snapmaker_thumbnails")
+THUMBNAIL_CACHE_SIZE = 64 * 1024 * 1024
+THUMBNAIL_MARGIN = 4 # pixels around the toolpath
+THUMBNAIL_CHUNK = 65536 # preview points drawn at once
+THUMBNAIL_SAMPLES = 1 << 20 # pixels sampled at once while drawing
+
+# The output of every operation is cached here by a hash of its commands,
+# the options and its entry state, least recently used entries are removed
+# above OPERATION_CACHE_SIZE bytes
+OPERATION_CACHE = True
+OPERATION_CACHE_DIR = os.path.join(getattr(FreeCAD, "getUserCachePath", tempfile.gettempdir)(), "snapmaker_operations")
+OPERATION_CACHE_SIZE = 512 * 1024 * 1024
+
+
+class GCodeWriter:
+    '''Buffered sink for the generated program.
+
+    Text is collected in a small buffer and flushed straight to the target
+    file, or to a list of chunks when posting to '-'. Header values that are
+    only known once the whole program was emitted (e.g. the boundary) are
+    written as fixed-width fields with reserve() and filled in with patch().
+    Text of unknown length (the thumbnail) goes to a mark() and is given
+    with insert(), the file is then spliced together on close().
+    '''
+
+    def __init__(self, filename, bufferSize=OUTPUT_BUFFER_SIZE):
+        self.filename = filename
+        self.bufferSize = bufferSize
+        self.buffer = []
+        self.buffered = 0  # characters in buffer
+        self.fields = {}
+        self.marks = {}
+        self.inserts = {}
+        self.lines = 0  # including the buffered ones
+        self.bytes = 0
+        self.seconds = 0.0  # spent joining and writing the output
+        if filename == '-':
+            self.chunks = []
+            self.file = None
+        else:
+            self.chunks = None
+            self.file = pythonopen(filename, "w+b")
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        self.lines += text.count("\n")
+        if self.buffered >= self.bufferSize:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        started = time.perf_counter()
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        if self.file is not None:
+            data = data.encode('utf-8')
+            self.file.write(data)
+        else:
+            self.chunks.append(data)
+        self.bytes += len(data)
+        self.seconds += time.perf_counter() - started
+
+    def linesWritten(self):
+        '''Lines written so far, including the buffered ones.'''
+        return self.lines
+
+    def reserve(self, name, width):
+        self.flush()
+        if self.file is not None:
+            self.fields[name] = (self.file.tell(), width)
+            self.file.write(b" " * width)
+        else:
+            self.fields[name] = (len(self.chunks), width)
+            self.chunks.append(" " * width)
+
+    def mark(self, name):
+        self.flush()
+        if self.file is not None:
+            self.marks[name] = self.file.tell()
+        else:
+            self.marks[name] = len(self.chunks)
+            self.chunks.append("")
+
+    def insert(self, name, text):
+        '''Puts the text at the mark, even when output was written after it.'''
+        self.inserts[name] = text
+        self.lines += text.count("\n")
+        self.bytes += len(text.encode('utf-8'))
+        if self.file is None:
+            self.chunks[self.marks[name]] = text
+
+    def patch(self, name, value):
+        position, width = self.fields[name]
+        text = str(value)
+        if len(text) > width:
+            raise ValueError("value %r does not fit into header field %s" % (text, name))
+        text = text.ljust(width)
+        if self.file is not None:
+            self.flush()
+            self.file.seek(position)
+            self.file.write(text.encode('utf-8'))
+            self.file.seek(0, 2)
+        else:
+            self.chunks[position] = text
+
+    def close(self):
+        '''Flush pending output. Returns the program text when posting to '-'.'''
+        self.flush()
+        started = time.perf_counter()
+        if self.file is not None:
+            spliced = self.splice() if any(self.inserts.values()) else None
+            self.file.close()
+            if spliced is not None:
+                shutil.copymode(self.filename, spliced)
+                os.replace(spliced, self.filename)
+            self.seconds += time.perf_counter() - started
+            return None
+        text = "".join(self.chunks)
+        self.seconds += time.perf_counter() - started
+        return text
+
+    def discard(self):
+        '''Drops the output, the target file is removed.'''
+        self.buffer = []
+        self.buffered = 0
+        if self.file is not None:
+            self.file.close()
+            os.unlink(self.filename)
+
+    def splice(self):
+        '''Writes the file with the inserted texts to a temporary file, returns its name.
+
+        Everything between the marks is copied by the kernel where possible.
+        '''
+        size = self.file.seek(0, 2)
+        self.file.flush()
+        source = self.file.fileno()
+        handle, spliced = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)), prefix=".snapmaker-")
+        try:
+            offset = 0
+            for name, position in sorted(self.marks.items(), key=lambda item: item[1]):
+                copyFileRange(source, handle, offset, position - offset)
+                os.write(handle, self.inserts.get(name, "").encode('utf-8'))
+                offset = position
+            copyFileRange(source, handle, offset, size - offset)
+        except BaseException:
+            os.close(handle)
+            os.unlink(spliced)
+            raise
+        os.close(handle)
+        return spliced
+
+
+def copyFileRange(source, target, offset, count):
+    '''Copies count bytes at offset of the source descriptor to the target's position.'''
+    end = offset + count
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                copied = os.copy_file_range(source, target, end - offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+        except OSError:
+            pass  # not supported for these files, copy in user space
+    while offset < end:
+        os.lseek(source, offset, os.SEEK_SET)
+        data = os.read(source, min(1 << 20, end - offset))
+        if not data:
+            break
+        os.write(target, data)
+        offset += len(data)
+
+
+class BoundaryAccumulator:
+    '''Running min/max of the emitted tool positions.
+
+    Fed by createCommand() for every point, so the boundary header costs O(1)
+    per move and never needs a second look at the generated text.
+    '''
+
+    def __init__(self):
+        self.minX = self.minY = self.minZ = math.inf
+        self.maxX = self.maxY = self.maxZ = -math.inf
+
+    def add(self, x, y, z):
+        if x < self.minX:
+            self.minX = x
+        if x > self.maxX:
+            self.maxX = x
+        if y < self.minY:
+            self.minY = y
+        if y > self.maxY:
+            self.maxY = y
+        self.addZ(z)
+
+    def addPoints(self, points):
+        '''Adds a (n, 3) array of points.'''
+        if len(points):
+            low = points.min(axis=0)
+            high = points.max(axis=0)
+            self.add(float(low[0]), float(low[1]), float(low[2]))
+            self.add(float(high[0]), float(high[1]), float(high[2]))
+
+    def merge(self, other):
+        if other.minX <= other.maxX:
+            self.add(other.minX, other.minY, other.minZ)
+            self.add(other.maxX, other.maxY, other.maxZ)
+        elif other.minZ <= other.maxZ:
+            self.addZ(other.minZ)
+            self.addZ(other.maxZ)
+
+    def addZ(self, z):
+        if z < self.minZ:
+            self.minZ = z
+        if z > self.maxZ:
+            self.maxZ = z
+
+    def fields(self, precision):
+        '''Header values keyed by BOUNDARY_FIELDS. Axes that never moved report 0.'''
+        precision_string = '.' + str(precision) + 'f'
+
+        def value(v):
+            return format(v, precision_string) if math.isfinite(v) else "0"
+
+        return {
+            "max_x(mm)": value(self.maxX),
+            "max_y(mm)": value(self.maxY),
+            "max_z(mm)": value(self.maxZ),
+            "max_b(mm)": "0",
+            "min_x(mm)": value(self.minX),
+            "min_y(mm)": value(self.minY),
+            "min_b(mm)": "0",
+            "min_z(mm)": value(self.minZ),
+        }
+
+
+class TimeEstimator:
+    '''Machining time estimate fed with the emitted point stream.
+
+    Without accelerations every segment takes length / feedrate. With
+    accelerations (mm/s^2 per axis) each segment is timed with a trapezoidal
+    speed profile: it starts and ends at the junction speed shared with its
+    neighbours, which drops to zero for turns of 90 degrees and more. The
+    last segment is kept pending until its successor is known.
+    '''
+
+    def __init__(self, accelerations=None):
+        self.accelerations = None if accelerations is None else np.array(accelerations, dtype=float)
+        self.position = None
+        self.seconds = 0.0
+        self.pending = None  # (length, speed, direction, acceleration, entry speed)
+
+    def add(self, x, y, z, feedrate):
+        self.addPoints(np.array([[x, y, z]], dtype=float), np.array([feedrate], dtype=float))
+
+    def dwell(self, seconds):
+        self.seconds += seconds
+
+    def addPoints(self, points, feedrates):
+        if self.position is None:
+            self.position = points[0]
+        starts = np.vstack((self.position, points[:-1]))
+        self.position = points[-1]
+        deltas = points - starts
+        lengths = np.sqrt((deltas * deltas).sum(axis=1))
+        moving = (lengths > 0) & (feedrates > 0)
+        if not moving.any():
+            return
+        lengths = lengths[moving]
+        speeds = feedrates[moving] / 60.0
+        if self.accelerations is None:
+            self.seconds += float((lengths / speeds).sum())
+            return
+
+        directions = deltas[moving] / lengths[:, None]
+        with np.errstate(divide='ignore'):
+            accelerations = (self.accelerations / np.abs(directions)).min(axis=1)
+        if self.pending is not None:
+            length, speed, direction, acceleration, entry = self.pending
+            lengths = np.concatenate(([length], lengths))
+            speeds = np.concatenate(([speed], speeds))
+            directions = np.vstack((direction, directions))
+            accelerations = np.concatenate(([acceleration], accelerations))
+        else:
+            entry = 0.0
+
+        cosines = np.clip((directions[:-1] * directions[1:]).sum(axis=1), 0, 1)
+        junctions = np.minimum(speeds[:-1], speeds[1:]) * cosines
+        entries = np.concatenate(([entry], junctions))
+        self.seconds += float(self.trapezoidTimes(lengths[:-1], speeds[:-1], accelerations[:-1], entries[:-1], junctions).sum())
+        self.pending = (lengths[-1], speeds[-1], directions[-1], accelerations[-1], entries[-1])
+
+    @staticmethod
+    def trapezoidTimes(lengths, speeds, accelerations, entries, exits):
+        accelerating = (speeds ** 2 - entries ** 2) / (2 * accelerations)
+        decelerating = (speeds ** 2 - exits ** 2) / (2 * accelerations)
+        cruising = lengths - accelerating - decelerating
+        trapezoid = ((speeds - entries) + (speeds - exits)) / accelerations + np.maximum(cruising, 0) / speeds
+        # too short to reach the feedrate: accelerate to a peak and decelerate right away
+        peak = np.sqrt(accelerations * lengths + (entries ** 2 + exits ** 2) / 2)
+        triangle = ((peak - entries) + (peak - exits)) / accelerations
+        # too short even for that: the speed changes linearly from entry to exit
+        ramp = 2 * lengths / np.maximum(entries + exits, 1e-9)
+        return np.where(cruising >= 0, trapezoid, np.where(peak >= np.maximum(entries, exits), triangle, ramp))
+
+    def total(self):
+        '''Estimated seconds including the pending segment, which ends at standstill.'''
+        seconds = self.seconds
+        if self.pending is not None:
+            length, speed, direction, acceleration, entry = self.pending
+            seconds += float(self.trapezoidTimes(np.array([length]), np.array([speed]), np.array([acceleration]),
+                                                 np.array([entry]), np.array([0.0]))[0])
+        return seconds
+
+
+class PostProfile:
+    '''Time spent in the posting stages and counters of the work done.
+
+    Stages are timed around whole operations and batches of moves, never per
+    command, so the profile is always collected and only reported with
+    --profile or --profile-json. Parse time excludes the other stages. With
+    --threads the stages of operations generated in parallel add up and may
+    exceed the total.
+    '''
+
+    STAGES = ("parse", "discretize", "format", "bounds", "write")
+    COUNTERS = ("operations", "cached", "commands", "moves", "batches", "points", "lines", "bytes")
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.counts = dict.fromkeys(self.COUNTERS, 0)
+        self.total = 0.0
+
+    def merge(self, other):
+        for stage in self.STAGES:
+            self.seconds[stage] += other.seconds[stage]
+        for counter in self.COUNTERS:
+            self.counts[counter] += other.counts[counter]
+
+    def report(self):
+        '''The profile as printable text.'''
+        lines = ["profile: %.3f s" % self.total]
+        for stage in self.STAGES + ("other",):
+            seconds = self.seconds[stage] if stage != "other" else max(self.total - sum(self.seconds.values()), 0.0)
+            lines.append("  %-10s %8.3f s %5.1f%%" % (stage, seconds, 100 * seconds / self.total if self.total > 0 else 0))
+        lines.append("  " + ", ".join("%s %d" % (counter, self.counts[counter]) for counter in self.COUNTERS))
+        if self.total > 0:
+            lines.append("  %.0f lines/s" % (self.counts["lines"] / self.total))
+        return "\n".join(lines)
+
+    def asDict(self):
+        return {"total_s": self.total, "seconds": self.seconds, "counts": self.counts}
+
+
+class SimplifyStats:
+    '''Number of moves seen and removed by simplifyPoints().'''
+
+    def __init__(self):
+        self.moves = 0
+        self.removed = 0
+
+    def merge(self, other):
+        self.moves += other.moves
+        self.removed += other.removed
+
+    def comment(self, tolerance):
+        return ";simplify: removed %d of %d moves (tolerance %s)\n" % (self.removed, self.moves, tolerance)
+
+
+class OrderStats:
+    '''Holes or contours reordered by orderHoles()/orderContours() and their travel before and after.'''
+
+    def __init__(self, stage, items):
+        self.stage = stage
+        self.items = items
+        self.count = 0
+        self.travelBefore = 0.0
+        self.travelAfter = 0.0
+
+    def merge(self, other):
+        self.count += other.count
+        self.travelBefore += other.travelBefore
+        self.travelAfter += other.travelAfter
+
+    def comment(self):
+        return ";%s: reordered %d %s, travel %.1f -> %.1f mm\n" % (self.stage, self.count, self.items, self.travelBefore, self.travelAfter)
+
+
+class ValidationError(ValueError):
+    '''The first violation with --strict, line counts from the start of its operation.'''
+
+    def __init__(self, line, message):
+        ValueError.__init__(self, message)
+        self.line = line
+
+    def __reduce__(self):
+        # raised in the worker processes of --threads
+        return (ValidationError, (self.line, str(self)))
+
+
+class Violations:
+    '''Moves beyond the machine envelope, feedrates above --max-feed and spindle speeds the toolhead can't run.
+
+    Points are checked batch by batch next to the boundary and time
+    accumulation, so a job without violations costs two array comparisons per
+    batch. The envelope is CORNER_MIN/CORNER_MAX moved by --work-origin,
+    without it only the extent of the whole job is compared by export().
+    Lines count from the start of the operation's output, None is the whole
+    job. The first VIOLATIONS_REPORTED are kept, the others only counted.
+    With --strict the first violation raises ValidationError.
+    '''
+
+    def __init__(self, post, speedFormat=UNIT_SPEED_FORMAT, output=None):
+        self.strict = post.strict
+        self.low = self.high = None
+        if post.workOrigin is not None:
+            origin = np.array(post.workOrigin, dtype=float)
+            self.low = np.array([CORNER_MIN['x'], CORNER_MIN['y'], CORNER_MIN['z']], dtype=float) - origin
+            self.high = np.array([CORNER_MAX['x'], CORNER_MAX['y'], CORNER_MAX['z']], dtype=float) - origin
+        self.maxFeedrate = post.maxFeedrate
+        if self.maxFeedrate is not None and speedFormat == 'in/min':
+            self.maxFeedrate /= 25.4
+        self.checkPoints = self.low is not None or self.maxFeedrate is not None
+        self.output = output
+        self.firstLine = output.linesWritten() if output is not None else 0
+        self.count = 0
+        self.found = []  # (line, message) of the first ones
+
+    def add(self, line, message):
+        if self.strict:
+            raise ValidationError(line, message)
+        self.count += 1
+        if len(self.found) < VIOLATIONS_REPORTED:
+            self.found.append((line, message))
+
+    def merge(self, other, offset):
+        '''Adds the violations of an operation starting offset lines into the output.'''
+        self.count += other.count
+        for line, message in other.found:
+            if len(self.found) < VIOLATIONS_REPORTED:
+                self.found.append((line + offset, message))
+
+    def restore(self, count, lines, messages):
+        '''Adds the violations of a cached operation.'''
+        for line, message in zip(lines, messages):
+            self.add(int(line), str(message))
+        self.count += int(count) - len(lines)
+
+    def nextLine(self):
+        '''Line of the next output of the operation.'''
+        return self.output.linesWritten() - self.firstLine + 1
+
+    def check(self, points, feedrates):
+        '''Indexes of the (n, 3) points or feedrates beyond the limits, None if there are none.'''
+        bad = None
+        if self.low is not None:
+            bad = (points < self.low).any(axis=1) | (points > self.high).any(axis=1)
+        if self.maxFeedrate is not None:
+            fast = feedrates > self.maxFeedrate
+            bad = fast if bad is None else bad | fast
+        if bad is None or not bad.any():
+            return None
+        return np.flatnonzero(bad)
+
+    def addPoints(self, ctx, points, feedrates, indexes):
+        '''Adds the violating points of a batch before createCommands() formats it.'''
+        lines = self.nextLine() + indexes
+        post = ctx.post
+        if not post.outputDoubles:
+            # --axis-modal drops the lines of points formatted like the one before
+            values = post.coordinateFormat.values(np.column_stack((points, feedrates)).ravel().tolist())
+            rows = [ctx.modal.values] + [values[i:i + 4] for i in range(0, len(values), 4)]
+            dropped = np.cumsum([rows[i + 1] == rows[i] for i in range(len(points))])
+            lines = lines - dropped[indexes]
+        for line, index in zip(lines.tolist(), indexes.tolist()):
+            self.add(line, self.describe(points[index], feedrates[index]))
+
+    def describe(self, point, feedrate):
+        '''What is wrong with the point.'''
+        problems = []
+        if self.low is not None:
+            for axis, value, low, high in zip("XYZ", point, self.low, self.high):
+                if value < low:
+                    problems.append("%s%.3f below %.3f" % (axis, value, low))
+                elif value > high:
+                    problems.append("%s%.3f above %.3f" % (axis, value, high))
+        if self.maxFeedrate is not None and feedrate > self.maxFeedrate:
+            problems.append("F%.3f above %.3f" % (feedrate, self.maxFeedrate))
+        return ", ".join(problems)
+
+    def checkExtent(self, boundary):
+        '''Adds the axes along which the job is larger than the machine envelope.'''
+        for axis, low, high in (("x", boundary.minX, boundary.maxX), ("y", boundary.minY, boundary.maxY), ("z", boundary.minZ, boundary.maxZ)):
+            size = CORNER_MAX[axis] - CORNER_MIN[axis]
+            if low <= high and high - low > size:
+                self.add(None, "spans %.3f mm in %s, the machine %.3f mm" % (high - low, axis.upper(), size))
+
+    def report(self):
+        '''The violations as printable text.'''
+        lines = ["validation: %d violations" % self.count]
+        for line, message in self.found:
+            lines.append("  %s: %s" % ("job" if line is None else "line %d" % line, message))
+        if self.count > len(self.found):
+            lines.append("  ...")
+        return "\n".join(lines)
+
+
+class PathRecorder:
+    '''Emitted tool positions kept for the toolpath preview.'''
+
+    def __init__(self, position):
+        self.arrays = []
+        self.pending = [(position.x, position.y, position.z)]
+
+    def add(self, x, y, z):
+        self.pending.append((x, y, z))
+
+    def addPoints(self, points):
+        self.flush()
+        self.arrays.append(points.astype(np.float32))
+
+    def flush(self):
+        if self.pending:
+            self.arrays.append(np.array(self.pending, dtype=np.float32))
+            self.pending = []
+
+    def points(self):
+        self.flush()
+        if not self.arrays:
+            return np.zeros((0, 3), dtype=np.float32)
+        return np.concatenate(self.arrays)
+
+
+# Records of the toolpath written with --toolpath, one per emitted point or
+# other output in the order of the output. Text records point into the
+# text file next to the records (x is the byte offset, y the length),
+# dwells keep their time in ms in x, spindle commands their RPM.
+TOOLPATH_DTYPE = np.dtype([("command", np.uint8), ("x", "<f8"), ("y", "<f8"), ("z", "<f8"), ("f", "<f8")])
+TOOLPATH_RAPID = 0  # G0 to x, y, z at feedrate f
+TOOLPATH_LINEAR = 1  # G1 to x, y, z at feedrate f
+TOOLPATH_DWELL = 2  # G4
+TOOLPATH_RESET = 3  # modal values are not relied on after other output
+TOOLPATH_TEXT = 4  # other output, without line numbers
+TOOLPATH_OPERATION = 5  # start of an operation, the text is its label
+TOOLPATH_SPINDLE = 6  # M3 at x RPM
+TOOLPATH_NOTE = 7  # comment on simplification or ordering at the end of the program
+TOOLPATH_TEXTS = (TOOLPATH_TEXT, TOOLPATH_OPERATION, TOOLPATH_NOTE)  # records with text
+TOOLPATH_CHUNK = 65536  # records emitted at once by emitRecords()
+
+LINE_NUMBER = re.compile(r"^N[0-9]+ ", re.MULTILINE)
+
+
+class ToolpathRecorder:
+    '''The output of an operation or program as TOOLPATH_DTYPE records and their text.'''
+
+    def __init__(self, label=None):
+        self.arrays = []
+        self.pending = []
+        self.text = []
+        self.textBytes = 0
+        if label is not None:
+            self.addText(label, TOOLPATH_OPERATION)
+
+    def add(self, command, x=0.0, y=0.0, z=0.0, f=0.0):
+        self.pending.append((command, x, y, z, f))
+
+    def addPoints(self, command, points, feedrates):
+        '''Adds a (n, 3) array of points.'''
+        self.flush()
+        records = np.empty(len(points), dtype=TOOLPATH_DTYPE)
+        records["command"] = command
+        records["x"] = points[:, 0]
+        records["y"] = points[:, 1]
+        records["z"] = points[:, 2]
+        records["f"] = feedrates
+        self.arrays.append(records)
+
+    def addText(self, text, command=TOOLPATH_TEXT):
+        data = LINE_NUMBER.sub("", text).encode('utf-8')
+        self.add(command, self.textBytes, len(data))
+        self.text.append(data)
+        self.textBytes += len(data)
+
+    def flush(self):
+        if self.pending:
+            self.arrays.append(np.array(self.pending, dtype=TOOLPATH_DTYPE))
+            self.pending = []
+
+    def merge(self, other):
+        '''Appends the records of the next operation.'''
+        self.flush()
+        other.flush()
+        for records in other.arrays:
+            isText = np.isin(records["command"], TOOLPATH_TEXTS)
+            records["x"][isText] += self.textBytes
+            self.arrays.append(records)
+        self.text.extend(other.text)
+        self.textBytes += other.textBytes
+
+    def save(self, path):
+        '''Writes the records to path and the text next to it, see toolpathPaths().'''
+        self.flush()
+        recordsPath, textPath = toolpathPaths(path)
+        records = np.concatenate(self.arrays) if self.arrays else np.zeros(0, dtype=TOOLPATH_DTYPE)
+        np.save(recordsPath, records)
+        np.save(textPath, np.frombuffer(b"".join(self.text), dtype=np.uint8))
+
+
+def toolpathPaths(path):
+    '''File names of the records and of the text of the toolpath at path.'''
+    if not path.endswith(".npy"):
+        path += ".npy"
+    return path, path[:-len(".npy")] + ".text.npy"
+
+
+def loadToolpath(path):
+    '''Records and text of a toolpath written with --toolpath, memory-mapped.'''
+    recordsPath, textPath = toolpathPaths(path)
+    records = np.load(recordsPath, mmap_mode='r')
+    if records.dtype != TOOLPATH_DTYPE:
+        raise ValueError("not a toolpath: %s" % recordsPath)
+    return records, np.load(textPath, mmap_mode='r')
+
+
+def toolpathText(text, record):
+    '''The text of a text record.'''
+    offset = int(record["x"])
+    return bytes(text[offset:offset + int(record["y"])]).decode('utf-8')
+
+
+def renderThumbnail(pointArrays, width, height):
+    '''Top-down grayscale PNG of the polyline through the (n, 3) point arrays, one after the other.
+
+    The toolpath is fitted into the image, deeper moves are drawn darker.
+    Points are drawn THUMBNAIL_CHUNK at a time, so memory doesn't grow with
+    the toolpath. Returns None when there is nothing to draw.
+    '''
+    pointArrays = [points for points in pointArrays if len(points)]
+    if sum(len(points) for points in pointArrays) < 2:
+        return None
+    low = np.min([points[:, :2].min(axis=0) for points in pointArrays], axis=0).astype(float)
+    high = np.max([points[:, :2].max(axis=0) for points in pointArrays], axis=0).astype(float)
+    zLow = min(float(points[:, 2].min()) for points in pointArrays)
+    zHigh = max(float(points[:, 2].max()) for points in pointArrays)
+    extent = np.maximum(high - low, 1e-9)
+    scale = min((width - 1 - 2 * THUMBNAIL_MARGIN) / extent[0], (height - 1 - 2 * THUMBNAIL_MARGIN) / extent[1])
+    offset = (np.array([width - 1, height - 1]) - extent * scale) / 2
+
+    image = np.full(width * height, 255, dtype=np.uint8)
+    previous = None
+    for points in pointArrays:
+        for first in range(0, len(points), THUMBNAIL_CHUNK):
+            chunk = points[first:first + THUMBNAIL_CHUNK].astype(float)
+            if previous is not None:
+                chunk = np.vstack((previous, chunk))  # the segment joining the chunks
+            previous = chunk[-1:]
+            if len(chunk) < 2:
+                continue
+            pixels = (chunk[:, :2] - low) * scale + offset
+            pixels[:, 1] = height - 1 - pixels[:, 1]  # image rows grow downwards
+            shades = 160 * (zHigh - chunk[:, 2]) / (zHigh - zLow) if zHigh > zLow else np.zeros(len(chunk))
+            shades = (200 - shades).astype(np.uint8)  # from light grey at the top to nearly black at the bottom
+            drawSegments(image, width, pixels, shades)
+    return pngBytes(image.reshape(height, width))
+
+
+def drawSegments(image, width, pixels, shades):
+    '''Draws the polyline through the pixels into the flat image, each segment in the shade of its end.'''
+    # sample every segment at least once per pixel, at most THUMBNAIL_SAMPLES samples at once
+    starts = pixels[:-1]
+    deltas = pixels[1:] - starts
+    counts = np.ceil(np.abs(deltas).max(axis=1)).astype(np.int64) + 1
+    ends = np.cumsum(counts)
+    first = 0
+    while first < len(starts):
+        before = ends[first - 1] if first else 0
+        last = max(int(np.searchsorted(ends, before + THUMBNAIL_SAMPLES, side='right')), first + 1)
+        batch = counts[first:last]
+        owner = np.repeat(np.arange(first, last), batch)
+        step = np.arange(len(owner)) - np.repeat(np.cumsum(batch) - batch, batch)
+        t = step / np.maximum(counts[owner] - 1, 1)
+        samples = np.rint(starts[owner] + deltas[owner] * t[:, None]).astype(np.int64)
+        np.minimum.at(image, samples[:, 1] * width + samples[:, 0], shades[1:][owner])
+        first = last
+
+
+def pngBytes(image):
+    '''Encodes a (height, width) uint8 array as grayscale PNG.'''
+    height, width = image.shape
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+    rows = np.hstack((np.zeros((height, 1), dtype=np.uint8), image))  # filter type 0 per row
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows.tobytes(), 9))
+            + chunk(b"IEND", b""))
+
+
+class LineNumbers:
+    '''Line numbers of one export, handed out in output order.
+
+    Called like a function, returns the "N<number> " prefix of the next line
+    or an empty string when line numbers are switched off.
+    '''
+
+    def __init__(self, enabled, start=None):
+        self.enabled = enabled
+        self.number = LINENR if start is None else start
+
+    def __call__(self):
+        if not self.enabled:
+            return ""
+        self.number += 10
+        return "N" + str(self.number) + " "
+
+
+class ModalState:
+    '''Last emitted command word and X, Y, Z, F values.
+
+    With --modal a repeated command word is dropped, with --axis-modal every
+    X, Y, Z or F value equal to the last emitted one. Values are compared as
+    formatted text, so the controller executes exactly the same motion.
+    '''
+
+    WORDS = ("X", "Y", "Z", "F")
+
+    def __init__(self, modal, outputDoubles, linenumber):
+        self.modal = modal
+        self.outputDoubles = outputDoubles
+        self.linenumber = linenumber
+        self.reset()
+
+    def reset(self):
+        '''Forget everything, e.g. after output the state does not know about.'''
+        self.command = None
+        self.values = [None, None, None, None]
+
+    def line(self, command, values):
+        '''Returns the line for the formatted values, empty if nothing changed.'''
+        words = []
+        last = self.values
+        for i in range(4):
+            if self.outputDoubles or values[i] != last[i]:
+                words.append(self.WORDS[i] + values[i])
+                last[i] = values[i]
+        if not words:
+            return ""
+        if not self.modal or command != self.command:
+            words.insert(0, command)
+            self.command = command
+        return self.linenumber() + " ".join(words) + "\n"
+
+
+class OperationContext:
+    '''State of posting one operation.
+
+    Operations only depend on each other through the head position and the
+    feedrates they start with. Every operation gets its own context with its
+    own output and accumulators, so operation bodies can be generated
+    independently and stitched together in order. The configuration is read
+    from the SnapmakerPost in ctx.post, which is never changed by posting.
+    '''
+
+    def __init__(self, post, label, commands, position, feedrateHorizontal, feedrateVertical, speedFormat, linenumber, output=None, preview=False):
+        self.post = post
+        self.label = label
+        self.commands = commands  # (name, parameters) of every command
+        self.position = FreeCAD.Vector(position)
+        self.feedrateHorizontal = feedrateHorizontal
+        self.feedrateVertical = feedrateVertical
+        self.speedFormat = speedFormat
+        self.linenumber = linenumber
+        self.output = output
+        self.boundary = BoundaryAccumulator()
+        self.estimator = post.timeEstimator()
+        self.estimator.position = np.array([position.x, position.y, position.z], dtype=float)
+        self.modal = ModalState(post.modal, post.outputDoubles, linenumber)
+        self.simplify = SimplifyStats()
+        self.preview = PathRecorder(position) if preview else None
+        self.drillTemplates = {}
+        self.profile = PostProfile()
+        self.drilling = OrderStats("drilling", "holes")
+        self.contours = OrderStats("contours", "contours")
+        self.violations = Violations(post, speedFormat, output)
+        self.toolpath = ToolpathRecorder(label) if post.toolpathFile else None
+        if commands is not None and (post.orderHoles or post.orderContours):
+            started = time.perf_counter()
+            if post.orderHoles:
+                orderHoles(self)
+            if post.orderContours:
+                orderContours(self)
+            self.profile.seconds["parse"] += time.perf_counter() - started
+
+    def exitState(self):
+        '''Head position and feedrates after this operation, without generating it.'''
+        scan = OperationContext(self.post, self.label, None, self.position, self.feedrateHorizontal, self.feedrateVertical, self.speedFormat, self.linenumber)
+        for command, params in self.commands:
+            if command[0] == '(':
+                continue
+            updateFeedrates(scan, params)
+            updatePosition(scan, command, params)
+        return scan.position, scan.feedrateHorizontal, scan.feedrateVertical
+
+
+def debugging():
+    '''True if debug messages of this module are shown.'''
+    return PathLog.getLevel(LOG_MODULE) == PathLog.Level.DEBUG
+
+def log(msg, *args):
+    '''Debug message, formatted with args only if debug messages are shown.'''
+    if debugging():
+        PathLog.debug(msg % args if args else msg)
 
 def warn(msg):
     PathLog.warning(msg)
@@ -196,445 +1070,1637 @@ def warn(msg):
 def err(msg):
     PathLog.error(msg)
 
-def processArguments(argstring):
-    # pylint: disable=global-statement
-    global OUTPUT_HEADER
-    global OUTPUT_COMMENTS
-    global OUTPUT_LINE_NUMBERS
-    global SHOW_EDITOR
-    global PRECISION
-    global PREAMBLE
-    global POSTAMBLE
-    global UNITS
-    global UNIT_SPEED_FORMAT
-    global UNIT_FORMAT
-    global MODAL
-    global USE_TLO
-    global OUTPUT_DOUBLES
-    global SEGMENTS_PER_CM_ARC
-    global BREAK_STRAIGHTS
-    global TOOLHEAD
-    global MOVE_COMMANDS
+@functools.lru_cache(maxsize=32)
+def parseArguments(argstring):
+    '''Parses the post processor arguments, cached by the argument string.
 
+    The returned namespace is shared between callers and must not be changed.
+    Raises ValueError on invalid arguments.
+    '''
     try:
         args = parser.parse_args(shlex.split(argstring))
-        if args.no_header:
-            OUTPUT_HEADER = False
-        if args.no_comments:
-            OUTPUT_COMMENTS = False
-        if args.line_numbers:
-            OUTPUT_LINE_NUMBERS = True
-        if args.no_show_editor:
-            SHOW_EDITOR = False
-        print("Show editor = %d" % SHOW_EDITOR)
-        PRECISION = args.precision
-
-        SEGMENTS_PER_CM_ARC = min(max(float(args.segments), 1), 100)
-        print("SEG/ARC:: "+ str(SEGMENTS_PER_CM_ARC))
-        if args.preamble is not None:
-            PREAMBLE = args.preamble
-        if args.postamble is not None:
-            POSTAMBLE = args.postamble
+    except SystemExit:
+        raise ValueError("invalid post processor arguments: %s" % argstring)
+    # convert and validate once, here, instead of on every SnapmakerPost
+    if args.precision is not None:
+        args.precision = int(args.precision)
+    if args.segments is not None:
+        args.segments = float(args.segments)
+    if args.chord_tolerance is not None:
+        args.chord_tolerance = float(args.chord_tolerance)
+        if not args.chord_tolerance > 0:
+            raise ValueError("chord tolerance must be positive")
+    if args.simplify is not None:
+        args.simplify = float(args.simplify)
+        if args.simplify < 0:
+            raise ValueError("simplify tolerance must not be negative")
+    if args.threads is not None:
+        args.threads = int(args.threads)
+    if args.max_feed is not None:
+        args.max_feed = float(args.max_feed)
+        if not args.max_feed > 0:
+            raise ValueError("maximum feed must be positive")
+    if args.work_origin is not None:
+        origin = tuple(float(value) for value in args.work_origin.split(','))
+        if len(origin) != 3:
+            raise ValueError("work origin must be X,Y,Z: %s" % args.work_origin)
+        args.work_origin = origin
+    args.jog_speed = float(args.jog_speed)
+    if not args.jog_speed > 0:
+        raise ValueError("jog speed must be positive")
+    width, _, height = args.thumbnail_size.partition('x')
+    args.thumbnail_size = (int(width), int(height))
+    if min(args.thumbnail_size) <= 2 * THUMBNAIL_MARGIN:
+        raise ValueError("thumbnail size too small: %s" % (args.thumbnail_size,))
+    return args
+
+
+class SnapmakerPost:
+    '''Snapmaker 2 post processor configured by an argument string.
+
+    Construction is cheap, parsed argument strings are cached. The
+    configuration is fixed after construction and every export keeps its
+    state (line numbers, head position, accumulators) to itself, so one
+    instance can be reused and shared between threads. The toolhead can be
+    given explicitly, otherwise --leveltwocnc selects ARCNC over SMCNC.
+    '''
+
+    def __init__(self, argstring="", toolhead=None):
+        args = parseArguments(argstring)
+        self.argstring = argstring
+        self.outputHeader = OUTPUT_HEADER and not args.no_header
+        self.outputComments = OUTPUT_COMMENTS and not args.no_comments
+        self.outputLineNumbers = OUTPUT_LINE_NUMBERS or args.line_numbers
+        self.showEditor = SHOW_EDITOR and not args.no_show_editor
+        # options that aren't given fall back to the globals above
+        self.precision = PRECISION if args.precision is None else args.precision
+        segments = SEGMENTS_PER_CM_ARC if args.segments is None else args.segments
+        self.segmentsPerCm = min(max(segments, 1), 100)
+        self.chordTolerance = CHORD_TOLERANCE if args.chord_tolerance is None else args.chord_tolerance
+        self.simplifyTolerance = SIMPLIFY_TOLERANCE if args.simplify is None else args.simplify
+        self.preamble = PREAMBLE if args.preamble is None else args.preamble
+        self.postamble = POSTAMBLE if args.postamble is None else args.postamble
+        self.units = UNITS
+        self.unitSpeedFormat = UNIT_SPEED_FORMAT
+        self.unitFormat = UNIT_FORMAT
         if args.inches:
-            UNITS = 'G20'
-            UNIT_SPEED_FORMAT = 'in/min'
-            UNIT_FORMAT = 'in'
-            PRECISION = 4
-        if args.modal:
-            MODAL = True
-        if args.no_tlo:
-            USE_TLO = False
-        if args.axis_modal:
-            print ('here')
-            OUTPUT_DOUBLES = False
-        if args.break_straight:
-            BREAK_STRAIGHTS = True
-        if args.leveltwocnc:
-            TOOLHEAD = ARCNC()
-        else:
-            TOOLHEAD = SMCNC()
-
-    except Exception: # pylint: disable=broad-except
-        return False
-
-    return True
-
+            self.units = 'G20'
+            self.unitSpeedFormat = 'in/min'
+            self.unitFormat = 'in'
+            self.precision = 4
+        self.trimZeros = TRIM_ZEROS or args.trim_zeros
+        self.coordinateFormat = coordinateFormat(self.precision, self.trimZeros)
+        self.modal = MODAL or args.modal
+        self.useTlo = USE_TLO and not args.no_tlo
+        self.outputDoubles = OUTPUT_DOUBLES and not args.axis_modal
+        self.breakStraights = BREAK_STRAIGHTS or args.break_straight
+        self.estimateAcceleration = ESTIMATE_ACCELERATION or args.estimate_acceleration
+        self.threads = max(THREADS if args.threads is None else args.threads, 1)
+        self.orderHoles = args.order_holes
+        self.orderContours = args.order_contours
+        self.jogSpeed = args.jog_speed if args.rapids else None
+        self.thumbnailSize = None if args.no_thumbnail else args.thumbnail_size
+        self.profile = args.profile
+        self.profileJson = args.profile_json
+        self.maxFeedrate = MAX_FEEDRATE if args.max_feed is None else args.max_feed
+        self.workOrigin = args.work_origin
+        self.strict = args.strict
+        self.toolpathFile = args.toolpath
+        if toolhead is None:
+            toolhead = TOOLHEAD
+        if toolhead is None:
+            toolhead = ARCNC if args.leveltwocnc else SMCNC
+        self.toolhead = toolhead() if isinstance(toolhead, type) else toolhead
+        # line numbers make every body depend on all operations before it,
+        # cached operations have no toolpath records
+        self.operationCache = OPERATION_CACHE and not args.no_cache and not self.outputLineNumbers and not self.toolpathFile
+        self.handlers = dict(COMMAND_HANDLERS)
+        self.handlers.update(getattr(self.toolhead, "handlers", {}))
+        self.spindlePowers = spindlePowerTable(self.toolhead.maxSpindleRPM, self.toolhead.minSpindlePower, self.toolhead.maxSpindlePower)
+        print("Show editor = %d" % self.showEditor)
+
+    def export(self, objectslist, filename):
+        '''Posts the objects to filename, '-' returns the program text.'''
+        for obj in objectslist:
+            if not hasattr(obj, "Path"):
+                print("the object " + obj.Name + " is not a path. Please select only path and Compounds.")
+                return None
+
+        print("postprocessing...")
+        exportStarted = time.perf_counter()
+
+        # collect the active operations, each with the speed unit of its job
+        operations = []
+        unitSpeedFormat = self.unitSpeedFormat
+        for obj in objectslist:
+
+            # Skip inactive operations
+            if hasattr(obj, 'Active'):
+                if not obj.Active:
+                    continue
+            if hasattr(obj, 'Base') and hasattr(obj.Base, 'Active'):
+                if not obj.Base.Active:
+                    continue
+
+            # fetch machine details
+            job = PathUtils.findParentJob(obj)
+
+            myMachine = 'not set'
+
+            if hasattr(job, "MachineName"):
+                myMachine = job.MachineName
+
+            if hasattr(job, "MachineUnits"):
+                if job.MachineUnits == "Metric":
+                    unitSpeedFormat = 'mm/min'
+                else:
+                    unitSpeedFormat = 'in/min'
 
-def export(objectslist, filename, argstring):
-    # pylint: disable=global-statement
-    if not processArguments(argstring):
-        return None
-    global UNITS
-    global UNIT_FORMAT
-    global UNIT_SPEED_FORMAT
 
-    for obj in objectslist:
-        if not hasattr(obj, "Path"):
-            print("the object " + obj.Name + " is not a path. Please select only path and Compounds.")
+            # get coolant mode
+            coolantMode = 'None'
+            if hasattr(obj, "CoolantMode") or hasattr(obj, 'Base') and  hasattr(obj.Base, "CoolantMode"):
+                if hasattr(obj, "CoolantMode"):
+                    coolantMode = obj.CoolantMode
+                else:
+                    coolantMode = obj.Base.CoolantMode
+
+            operations.append((obj.Label, operationCommands(obj), unitSpeedFormat))
+
+        digests = None
+        if self.operationCache or (self.outputHeader and self.thumbnailSize is not None):
+            digests = [commandsDigest(commands) for _, commands, _ in operations]
+        thumbnailKey = None
+        if self.outputHeader and self.thumbnailSize is not None:
+            thumbnailKey = self.thumbnailKey(operations, digests)
+
+        def generate(gcode, linenumber, preview, position):
+            return self.generateOperations(operations, gcode, linenumber, preview, digests, position)
+
+        return self.writeProgram(filename, generate, thumbnailKey, exportStarted)
+
+    def emitToolpath(self, path, filename):
+        '''Formats a toolpath recorded with --toolpath to filename, '-' returns the program text.
+
+        The points are emitted as recorded, so the options of discretization
+        and ordering have no effect, the formatting options do. The header,
+        validation and preview are computed from the records again, the
+        comments on simplification and ordering are the recorded ones.
+        '''
+        print("postprocessing...")
+        started = time.perf_counter()
+        records, text = loadToolpath(path)
+
+        def generate(gcode, linenumber, preview, position):
+            return self.toolpathOperations(records, text, gcode, linenumber, preview, position)
+
+        notes = [toolpathText(text, record) for record in records[records["command"] == TOOLPATH_NOTE]]
+        return self.writeProgram(filename, generate, None, started, notes)
+
+    def writeProgram(self, filename, generate, thumbnailKey, exportStarted, notes=None):
+        '''Writes the header, the operations and the postamble to filename, '-' returns the program text.
+
+        generate(gcode, linenumber, preview, position) yields the contexts of
+        the operations in order, the first one starting at position. The thumbnail is read from and written to the
+        cache if thumbnailKey is given. The comments on simplification and
+        ordering are made from the operations unless notes gives them, as
+        recorded in a toolpath.
+        '''
+        # the toolpath preview is rendered from the emitted moves unless cached
+        thumbnail = None
+        if thumbnailKey is not None:
+            thumbnail = readThumbnailCache(thumbnailKey)
+        recordPreview = self.outputHeader and self.thumbnailSize is not None and thumbnail is None
+
+        boundary = BoundaryAccumulator()
+        linenumber = LineNumbers(self.outputLineNumbers)
+
+        gcode = GCodeWriter(filename)
+
+        # write header
+        headerBytes = 0
+        position = START_POSITION
+        seconds = 0.0
+        if self.outputHeader:
+            gcode.write(linenumber() + ";Exported for Snapmaker 2\n")
+            gcode.write(linenumber() + ";Post Processor: " + __name__ + "\n")
+            gcode.write(linenumber() + ";Output Time:" + str(datetime.datetime.now()) + "\n")
+            gcode.write(linenumber() + ";Header Start\n;header_type: cnc\n;tool_head: " + self.toolhead.header + "\n;machine: "+ MACHINE_NAME +"\n;gcode_flavor: marlin\n")
+            # these values are patched in once the whole program is known
+            for field in HEADER_FIELDS:
+                gcode.write(";" + field + ": ")
+                gcode.reserve(field, HEADER_FIELD_WIDTH)
+                gcode.write("\n")
+            if thumbnail is not None:
+                gcode.write(thumbnailLine(thumbnail))
+            elif recordPreview:
+                gcode.mark("thumbnail")
+            gcode.write(";Header End\n")
+            gcode.flush()
+            headerBytes = gcode.bytes
+            gcode.write(linenumber() + self.preamble + "\n")
+            gcode.write(linenumber() + "G0 Z%.2f F%d" % (PREAMBLE_Z, PREAMBLE_FEEDRATE) + "\n")
+            boundary.addZ(PREAMBLE_Z)
+            # the first operation starts where this move ends
+            position = FreeCAD.Vector(START_POSITION.x, START_POSITION.y, PREAMBLE_Z)
+            estimator = self.timeEstimator()
+            estimator.position = np.array([START_POSITION.x, START_POSITION.y, START_POSITION.z], dtype=float)
+            estimator.add(position.x, position.y, position.z, PREAMBLE_FEEDRATE)
+            seconds = estimator.total()
+            # gcode.write(linenumber() + "G0 Z0.50 F120" + "\n")
+            PathLog.debug("===== Post-process for Snapmaker 2 (export linear moves only) =====\n")
+
+        gcode.write(linenumber() + self.units + "\n")
+
+        simplified = SimplifyStats()
+        drilled = OrderStats("drilling", "holes")
+        contours = OrderStats("contours", "contours")
+        violations = Violations(self)
+        toolpath = ToolpathRecorder() if self.toolpathFile else None
+        previews = []
+        profile = PostProfile()
+        # line of the output the next operation starts after
+        operationStart = gcode.linesWritten()
+        try:
+            for ctx in generate(gcode, linenumber, recordPreview, position):
+                # stitch the operation gcode into the output
+                if ctx.output is not gcode:
+                    ctx.output.flush()
+                    for chunk in ctx.output.chunks:
+                        gcode.write(chunk)
+                boundary.merge(ctx.boundary)
+                seconds += ctx.estimator.total()
+                simplified.merge(ctx.simplify)
+                drilled.merge(ctx.drilling)
+                contours.merge(ctx.contours)
+                violations.merge(ctx.violations, operationStart)
+                if toolpath is not None:
+                    toolpath.merge(ctx.toolpath)
+                profile.merge(ctx.profile)
+                if ctx.output is not gcode:
+                    profile.seconds["write"] += ctx.output.seconds
+                if ctx.preview is not None:
+                    previews.append(ctx.preview.points())
+
+                # do the post_op
+                if self.outputComments:
+                    gcode.write(linenumber() + ";finish operation: %s\n" % ctx.label)
+                for line in POST_OPERATION.splitlines(True):
+                    gcode.write(linenumber() + line)
+                operationStart = gcode.linesWritten()
+            if self.workOrigin is None:
+                violations.checkExtent(boundary)
+        except ValidationError as e:
+            gcode.discard()
+            # counted as if the thumbnail was inserted
+            where = "job" if e.line is None else "line %d" % (operationStart + e.line + recordPreview)
+            print("validation failed, %s: %s" % (where, e))
             return None
 
-    print("postprocessing...")
-    gcode = ""
-
-    # prepare to take picture
-    FreeCAD.Gui.activeDocument().activeView().viewIsometric()
-    FreeCAD.Gui.SendMsgToActiveView("ViewFit")
-    imagePath = FreeCAD.Gui.activeDocument().Document.FileName + ".png"
-    FreeCAD.Gui.activeDocument().activeView().saveImage(imagePath,720,480,'White')
-
-    imageBase64 = ""
-    with open(imagePath, "rb") as image_file:
-        imageBase64 = base64.b64encode(image_file.read())
-
-    # write header
-    if OUTPUT_HEADER:
-        gcode += linenumber() + ";Exported for Snapmaker 2\n"
-        gcode += linenumber() + ";Post Processor: " + __name__ + "\n"
-        gcode += linenumber() + ";Output Time:" + str(now) + "\n"
-        if not imageBase64 == "":
-            gcode += linenumber() + ";Header Start\n;header_type: cnc\n;tool_head: " + TOOLHEAD.header + "\n;machine: "+ MACHINE_NAME +"\n;gcode_flavor: marlin" "\n;thumbnail: data:image/png;base64,"+ imageBase64.decode() + "\n;Header End\n"
-        gcode += linenumber() + PREAMBLE + "\n"        
-        gcode += linenumber() + "G0 Z10.00 F300" + "\n"
-        # gcode += linenumber() + "G0 Z0.50 F120" + "\n"
-        PathLog.debug("===== Post-process for Snapmaker 2 (export linear moves only) =====\n")
-
-    gcode += linenumber() + UNITS + "\n"
-
-    for obj in objectslist:
-
-        # Skip inactive operations
-        if hasattr(obj, 'Active'):
-            if not obj.Active:
-                continue
-        if hasattr(obj, 'Base') and hasattr(obj.Base, 'Active'):
-            if not obj.Base.Active:
-                continue
-
-        # fetch machine details
-        job = PathUtils.findParentJob(obj)
-
-        myMachine = 'not set'
-
-        if hasattr(job, "MachineName"):
-            myMachine = job.MachineName
-
-        if hasattr(job, "MachineUnits"):
-            if job.MachineUnits == "Metric":
-                UNITS = "G21"
-                UNIT_FORMAT = 'mm'
-                UNIT_SPEED_FORMAT = 'mm/min'
+        # do the post_amble
+        if self.outputComments:
+            if violations.count:
+                gcode.write(linenumber() + ";validation: %d violations\n" % violations.count)
+            if notes is None:
+                notes = []
+                if self.simplifyTolerance is not None:
+                    notes.append(simplified.comment(self.simplifyTolerance))
+                if self.orderHoles:
+                    notes.append(drilled.comment())
+                if self.orderContours:
+                    notes.append(contours.comment())
+            for note in notes:
+                gcode.write(linenumber() + note)
+                if toolpath is not None:
+                    toolpath.addText(note, TOOLPATH_NOTE)
+            gcode.write(";begin postamble\n")
+        for line in self.postamble.splitlines(True):
+            gcode.write(linenumber() + line)
+
+        #;max_x(mm): 35.512     # Example boundary headers
+        #;max_y(mm): 318.811    # 
+        #;max_z(mm): 80         # 
+        #;max_b(mm): 0          # maybe b is rotary? have no idea
+        #;min_x(mm): 20.232     # 
+        #;min_y(mm): 315.667    # 
+        #;min_b(mm): 0          # 
+        #;min_z(mm): -2         # 
+
+        if recordPreview:
+            started = time.perf_counter()
+            thumbnail = renderThumbnail(previews, *self.thumbnailSize)
+            if thumbnail is not None:
+                if thumbnailKey is not None:
+                    writeThumbnailCache(thumbnailKey, thumbnail)
+                    pruneCache(THUMBNAIL_CACHE_DIR, ".png", THUMBNAIL_CACHE_SIZE)
+                gcode.insert("thumbnail", thumbnailLine(thumbnail))
+                headerBytes += len(thumbnailLine(thumbnail))
+                print("thumbnail: %dx%d, %d bytes, rendered in %.3f s" % (self.thumbnailSize + (len(thumbnail), time.perf_counter() - started)))
+                # the body moved down by the thumbnail line
+                violations.found = [(None if line is None else line + 1, message) for line, message in violations.found]
+        elif thumbnail is not None:
+            print("thumbnail: %dx%d, %d bytes, from cache" % (self.thumbnailSize + (len(thumbnail),)))
+        if violations.count:
+            print(violations.report())
+        if self.outputHeader:
+            print("header: %d bytes" % headerBytes)
+
+        # fill in the reserved fields of the header
+        if gcode.fields:
+            gcode.flush()
+            values = boundary.fields(self.precision)
+            values["file_total_lines"] = gcode.lines
+            values["estimated_time(s)"] = format(seconds, '.1f')
+            for field in HEADER_FIELDS:
+                gcode.patch(field, values[field])
+
+        final = gcode.close()
+        if self.operationCache:
+            pruneCache(OPERATION_CACHE_DIR, ".npz", OPERATION_CACHE_SIZE)
+        if toolpath is not None:
+            toolpath.save(self.toolpathFile)
+        profile.seconds["write"] += gcode.seconds
+        profile.counts["lines"] = gcode.lines
+        profile.counts["bytes"] = gcode.bytes
+        profile.total = time.perf_counter() - exportStarted
+        if self.profile:
+            print(profile.report())
+        if self.profileJson:
+            with pythonopen(self.profileJson, "w") as jsonFile:
+                json.dump(profile.asDict(), jsonFile, indent=2)
+
+        if FreeCAD.GuiUp and self.showEditor:
+            if final is None:
+                with pythonopen(filename, "r") as gfile:
+                    final = gfile.read()
+            dia = PostUtils.GCodeEditorDialog()
+            dia.editor.setText(final)
+            result = dia.exec_()
+            if result:
+                final = dia.editor.toPlainText()
+                if not filename == '-':
+                    with pythonopen(filename, "w") as gfile:
+                        gfile.write(final)
+
+        print("done postprocessing.")
+
+        # the program text is only kept in memory when posting to '-' or editing
+        if final is None:
+            return filename
+        return final
+
+    def generateOperations(self, operations, gcode, linenumber, preview=False, digests=None, position=START_POSITION):
+        '''Generates the (label, commands, speed unit) operations, yields their contexts in order.
+
+        The first operation starts at position. With more than one thread
+        the entry state of every operation is found by a quick scan of its
+        predecessors and the bodies are generated in parallel by --threads
+        worker processes, as parsing and formatting hold the GIL. Otherwise each body is written
+        straight to gcode. Line numbers are handed out in output order, so
+        they force serial mode. With preview the emitted points are recorded.
+        With the operation cache (digests of the commands are given) unchanged
+        operations are restored from the cache, the others are generated into
+        their own chunk lists and cached.
+        '''
+        threads = self.threads
+        horizontal = feedrateHorizontal
+        vertical = feedrateVertical
+        cache = self.operationCache and digests is not None
+
+        def start(index, output):
+            '''Context of the operation, restored from the cache if possible, and its cache key.'''
+            label, commands, speedFormat = operations[index]
+            key = None
+            if cache:
+                key = self.operationKey(digests[index], speedFormat, position, horizontal, vertical)
+                cached = readOperationCache(key)
+                # entries written without preview can't give the points of the thumbnail
+                if cached is not None and (not preview or "preview" in cached):
+                    ctx = OperationContext(self, label, None, position, horizontal, vertical, speedFormat, linenumber, GCodeWriter('-'), preview)
+                    restoreOperation(ctx, cached)
+                    return ctx, None
+                output = GCodeWriter('-')
+            return OperationContext(self, label, commands, position, horizontal, vertical, speedFormat, linenumber, output, preview), key
+
+        if threads <= 1 or self.outputLineNumbers or len(operations) < 2:
+            for index in range(len(operations)):
+                ctx, key = start(index, gcode)
+                if key is not None:
+                    parse(ctx)
+                    writeOperationCache(key, ctx)
+                elif ctx.commands is not None:
+                    parse(ctx)
+                position, horizontal, vertical = ctx.position, ctx.feedrateHorizontal, ctx.feedrateVertical
+                yield ctx
+            return
+
+        contexts = []
+        for index in range(len(operations)):
+            ctx, key = start(index, GCodeWriter('-'))
+            contexts.append((ctx, key))
+            if ctx.commands is None:
+                position, horizontal, vertical = ctx.position, ctx.feedrateHorizontal, ctx.feedrateVertical
             else:
-                UNITS = "G20"
-                UNIT_FORMAT = 'in'
-                UNIT_SPEED_FORMAT = 'in/min'
-
-
-        # get coolant mode
-        coolantMode = 'None'
-        if hasattr(obj, "CoolantMode") or hasattr(obj, 'Base') and  hasattr(obj.Base, "CoolantMode"):
-            if hasattr(obj, "CoolantMode"):
-                coolantMode = obj.CoolantMode
-            else:
-                coolantMode = obj.Base.CoolantMode
-
-        # process the operation gcode
-        gcode += parse(obj)
-
-        # do the post_op
-        if OUTPUT_COMMENTS:
-            gcode += linenumber() + ";finish operation: %s\n" % obj.Label
-        for line in POST_OPERATION.splitlines(True):
-            gcode += linenumber() + line
-
-    # do the post_amble
-    if OUTPUT_COMMENTS:
-        gcode += ";begin postamble\n"
-    for line in POSTAMBLE.splitlines(True):
-        gcode += linenumber() + line
-
-    # generate boundary
-
-    Xmoves=[]
-    Ymoves=[]
-    Zmoves=[]
-    Bmoves=[0] # placeholder
-    for line in gcode.split("\n"):
-        #print(line)
-        if any(move_command in line for move_command in MOVE_COMMANDS):
-            command = line.split()
-            # add all x,y,z position values to a list
-            if len(list(filter(lambda x: "X" in x, command))):
-                Xmoves.append(float(list(filter(lambda x: "X" in x, command))[0][1:]))
-            if len(list(filter(lambda x: "Y" in x, command))):
-                Ymoves.append(float(list(filter(lambda y: "Y" in y, command))[0][1:]))
-            if len(list(filter(lambda x: "Z" in x, command))):
-                Zmoves.append(float(list(filter(lambda z: "Z" in z, command))[0][1:]))
-
-    #;max_x(mm): 35.512     # Example boundary headers
-    #;max_y(mm): 318.811    # 
-    #;max_z(mm): 80         # 
-    #;max_b(mm): 0          # maybe b is rotary? have no idea
-    #;min_x(mm): 20.232     # 
-    #;min_y(mm): 315.667    # 
-    #;min_b(mm): 0          # 
-    #;min_z(mm): -2         # 
-
-    # create boundary string
-    bdry = f""";max_x(mm): {max(Xmoves)}
-;max_y(mm): {max(Ymoves)}
-;max_z(mm): {max(Zmoves)}
-;max_b(mm): {max(Bmoves)}
-;min_x(mm): {min(Xmoves)}
-;min_y(mm): {min(Ymoves)}
-;min_b(mm): {min(Bmoves)}
-;min_z(mm): {min(Zmoves)}\n"""
-
-    #add the boundary string to the preamble
-    preamble_position = gcode.find(";thumbnail: data:image/png;base64") # will give the position of the first letter
-    gcode = gcode[:preamble_position] + bdry + gcode[preamble_position:]
-
-
-    if FreeCAD.GuiUp and SHOW_EDITOR:
-        dia = PostUtils.GCodeEditorDialog()
-        dia.editor.setText(gcode)
-        result = dia.exec_()
-        if result:
-            final = dia.editor.toPlainText()
-        else:
-            final = gcode
+                position, horizontal, vertical = ctx.exitState()
+
+        # keep only a few finished bodies in memory ahead of the writer
+        with concurrent.futures.ProcessPoolExecutor(threads, mp_context=workerContext()) as pool:
+            pending = collections.deque()
+            for ctx, key in contexts:
+                future = None
+                if ctx.commands is not None:
+                    position = (ctx.position.x, ctx.position.y, ctx.position.z)
+                    future = pool.submit(generateInWorker, self, ctx.label, ctx.commands, position,
+                                         ctx.feedrateHorizontal, ctx.feedrateVertical, ctx.speedFormat, preview,
+                                         ctx.drilling, ctx.contours)
+                pending.append((ctx, key, future))
+                if len(pending) >= 2 * threads:
+                    yield finishOperation(*pending.popleft())
+            while pending:
+                yield finishOperation(*pending.popleft())
+
+    def toolpathOperations(self, records, text, gcode, linenumber, preview=False, position=START_POSITION):
+        '''Yields the contexts of the operations of toolpath records, written straight to gcode.'''
+        starts = np.flatnonzero(records["command"] == TOOLPATH_OPERATION).tolist()
+        for first, last in zip(starts, starts[1:] + [len(records)]):
+            label = toolpathText(text, records[first])
+            ctx = OperationContext(self, label, None, position, feedrateHorizontal, feedrateVertical, self.unitSpeedFormat, linenumber, gcode, preview)
+            emitRecords(ctx, records[first + 1:last], text)
+            position = ctx.position
+            yield ctx
+
+    def timeEstimator(self):
+        '''TimeEstimator with the accelerations of the machine if --estimate-acceleration is given.'''
+        if self.estimateAcceleration:
+            return TimeEstimator([MAX_ACCELERATION['x'], MAX_ACCELERATION['y'], MAX_ACCELERATION['z']])
+        return TimeEstimator()
+
+    def thumbnailKey(self, operations, digests):
+        '''Cache key of the toolpath preview, a hash of the commands and options.'''
+        key = hashlib.sha1(repr((postVersion(), self.argstring, self.thumbnailSize, START_POSITION.x, START_POSITION.y, START_POSITION.z)).encode('utf-8'))
+        for (label, commands, speedFormat), digest in zip(operations, digests):
+            key.update(speedFormat.encode('utf-8'))
+            key.update(digest.encode('utf-8'))
+        return key.hexdigest()
+
+    def operationKey(self, digest, speedFormat, position, horizontal, vertical):
+        '''Cache key of the output of an operation, a hash of everything parse() depends on.'''
+        toolhead = self.toolhead
+        settings = (postVersion(), digest, speedFormat, position.x, position.y, position.z, horizontal, vertical,
+                    self.precision, self.trimZeros, self.segmentsPerCm, self.chordTolerance, self.simplifyTolerance,
+                    self.breakStraights, self.modal, self.outputDoubles, self.estimateAcceleration,
+                    self.orderHoles, self.orderContours, self.jogSpeed, self.maxFeedrate, self.workOrigin,
+                    sorted(CORNER_MIN.items()), sorted(CORNER_MAX.items()), VIOLATIONS_REPORTED,
+                    toolhead.maxSpindleRPM, toolhead.minSpindlePower, toolhead.maxSpindlePower,
+                    sorted((name, handler.__module__, handler.__qualname__) for name, handler in self.handlers.items()),
+                    sorted(MAX_ACCELERATION.items()), MAX_CHORD_ANGLE, MOVE_BATCH_SIZE,
+                    holeRetractionFactor, moveDrillInRetractHeight, HOLE_2OPT_LIMIT, HOLE_2OPT_PASSES)
+        return hashlib.sha1(repr(settings).encode('utf-8')).hexdigest()
+
+
+DIGEST_BLOCK = 4096  # commands hashed at once in commandsDigest()
+
+
+def commandsDigest(commands):
+    '''Hash of the (name, parameters) of the commands.
+
+    The names are hashed as text and the parameter values, which FreeCAD
+    keeps as floats, packed as float64, far faster than their repr().
+    '''
+    digest = hashlib.sha1()
+    for first in range(0, len(commands), DIGEST_BLOCK):
+        names = []
+        values = []
+        for command, params in commands[first:first + DIGEST_BLOCK]:
+            names.append(command)
+            names.extend(params)
+            names.append("\n")
+            values.extend(params.values())
+        digest.update(" ".join(names).encode('utf-8'))
+        digest.update(np.array(values, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=1)
+def postVersion():
+    '''Hash of this file, cached operations are only reused by the same version.'''
+    with pythonopen(__file__, "rb") as source:
+        return hashlib.sha1(source.read()).hexdigest()
+
+
+def readOperationCache(key):
+    '''The arrays cached by writeOperationCache(), None if there are none.'''
+    path = os.path.join(OPERATION_CACHE_DIR, key + ".npz")
+    try:
+        with np.load(path, allow_pickle=False) as entry:
+            cached = {name: entry[name] for name in entry.files}
+        os.utime(path)  # most recently used, see pruneCache()
+    except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+        return None
+    return cached
+
+
+def operationArrays(ctx):
+    '''The output and statistics of the posted operation as arrays, see restoreOperation().'''
+    ctx.output.flush()
+    boundary = ctx.boundary
+    arrays = {
+        "body": np.frombuffer("".join(ctx.output.chunks).encode('utf-8'), dtype=np.uint8),
+        "boundary": np.array([boundary.minX, boundary.minY, boundary.minZ, boundary.maxX, boundary.maxY, boundary.maxZ]),
+        "seconds": np.array([ctx.estimator.total()]),
+        "simplify": np.array([ctx.simplify.moves, ctx.simplify.removed]),
+        "drilling": np.array([ctx.drilling.count, ctx.drilling.travelBefore, ctx.drilling.travelAfter]),
+        "contours": np.array([ctx.contours.count, ctx.contours.travelBefore, ctx.contours.travelAfter]),
+        "exit": np.array([ctx.position.x, ctx.position.y, ctx.position.z, ctx.feedrateHorizontal, ctx.feedrateVertical]),
+        "violations": np.array([ctx.violations.count]),
+        "violationLines": np.array([line for line, _ in ctx.violations.found], dtype=np.int64),
+        "violationMessages": np.array([message for _, message in ctx.violations.found], dtype=str),
+    }
+    if ctx.preview is not None:
+        arrays["preview"] = ctx.preview.points()
+    return arrays
+
+
+def writeOperationCache(key, ctx):
+    '''Caches the output and statistics of the posted operation.'''
+    arrays = operationArrays(ctx)
+    try:
+        os.makedirs(OPERATION_CACHE_DIR, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=OPERATION_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(handle, "wb") as entry:
+            np.savez(entry, **arrays)
+        os.replace(temporary, os.path.join(OPERATION_CACHE_DIR, key + ".npz"))
+    except OSError as e:
+        warn("cannot cache operation %s: %s" % (ctx.label, e))
+
+
+def restoreOperation(ctx, cached, profile=None, toolpath=None):
+    '''Fills the context of an operation from its cached arrays instead of parse().
+
+    The arrays of an operation generated by a worker process come with its
+    profile and toolpath, see generateInWorker().
+    '''
+    ctx.output.write(cached["body"].tobytes().decode('utf-8'))
+    boundary = ctx.boundary
+    boundary.minX, boundary.minY, boundary.minZ, boundary.maxX, boundary.maxY, boundary.maxZ = cached["boundary"].tolist()
+    ctx.estimator.seconds = float(cached["seconds"][0])
+    moves, removed = cached["simplify"].tolist()
+    ctx.simplify.moves, ctx.simplify.removed = int(moves), int(removed)
+    for stats, name in ((ctx.drilling, "drilling"), (ctx.contours, "contours")):
+        count, stats.travelBefore, stats.travelAfter = cached[name].tolist()
+        stats.count = int(count)
+    ctx.violations.restore(cached["violations"][0], cached["violationLines"], cached["violationMessages"])
+    if ctx.preview is not None:
+        ctx.preview.pending = []
+        ctx.preview.arrays = [cached["preview"]]
+    x, y, z, ctx.feedrateHorizontal, ctx.feedrateVertical = cached["exit"].tolist()
+    ctx.position = FreeCAD.Vector(x, y, z)
+    if toolpath is not None:
+        ctx.toolpath = toolpath
+    if profile is not None:
+        ctx.profile.merge(profile)
     else:
-        final = gcode
-
-    print("done postprocessing.")
-
-    if not filename == '-':
-        gfile = pythonopen(filename, "w")
-        gfile.write(final)
-        gfile.close()
-
-    return final
-
+        ctx.profile.counts["operations"] += 1
+        ctx.profile.counts["cached"] += 1
 
-def linenumber():
-    # pylint: disable=global-statement
-    global LINENR
-    if OUTPUT_LINE_NUMBERS is True:
-        LINENR += 10
-        return "N" + str(LINENR) + " "
-    return ""
-
-
-def createCommand(command, x, y, z, feedrate):
-    precision_string = '.' + str(PRECISION) + 'f'
-
-    xFormatted = format(float(x), precision_string)
-    yFormatted = format(float(y), precision_string)
-    zFormatted = format(float(z), precision_string)
-    feedrateFormatted = format(float(feedrate), precision_string)
-    return linenumber() + "{command} X{x} Y{y} Z{z} F{feedrate}\n".format(command=command, x=xFormatted, y=yFormatted, z=zFormatted, feedrate=feedrateFormatted)
-
-def createNoPosCommand(command, params):
-    return linenumber() + "{command} {params}\n".format(command=command, params=params)
 
+def pruneCache(directory, extension, size):
+    '''Removes the least recently used entries ending in extension until the cache fits into size bytes.'''
+    entries = []
+    try:
+        with os.scandir(directory) as found:
+            for entry in found:
+                if entry.name.endswith(extension):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except OSError:
+        return
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # removed by another export
+        total -= size
+
+
+def generateInWorker(post, label, commands, position, horizontal, vertical, speedFormat, preview, drilling, contours):
+    '''Generates an operation in a worker process of --threads.
+
+    The commands were already ordered, drilling and contours are the
+    OrderStats of that. Returns the operationArrays(), profile and toolpath
+    of the operation for restoreOperation().
+    '''
+    ctx = OperationContext(post, label, None, FreeCAD.Vector(*position), horizontal, vertical, speedFormat, LineNumbers(False), GCodeWriter('-'), preview)
+    ctx.commands = commands
+    ctx.drilling = drilling
+    ctx.contours = contours
+    parse(ctx)
+    return operationArrays(ctx), ctx.profile, ctx.toolpath
+
+
+def workerContext():
+    '''Start method of the --threads workers. Forked where possible, FreeCAD's executable is no plain interpreter to spawn.'''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('spawn')
+
+
+def finishOperation(ctx, key, future):
+    '''Waits for the operation generated by a worker process and caches it if it has a key.'''
+    if future is not None:
+        restoreOperation(ctx, *future.result())
+    if key is not None:
+        writeOperationCache(key, ctx)
+    return ctx
+
+
+def thumbnailLine(png):
+    return ";thumbnail: data:image/png;base64," + base64.b64encode(png).decode() + "\n"
+
+
+def readThumbnailCache(key):
+    path = os.path.join(THUMBNAIL_CACHE_DIR, key + ".png")
+    try:
+        with pythonopen(path, "rb") as image:
+            png = image.read()
+        os.utime(path)  # most recently used, see pruneCache()
+        return png
+    except OSError:
+        return None
 
-def parse(pathobj):
-    # pylint: disable=global-statement
-    global PRECISION
-    global MODAL
-    global OUTPUT_DOUBLES
-    global UNIT_FORMAT
-    global UNIT_SPEED_FORMAT
-    global SEGMENTS_PER_CM_ARC
 
-    global feedrateHorizontal
-    global feedrateVertical
+def writeThumbnailCache(key, png):
+    try:
+        os.makedirs(THUMBNAIL_CACHE_DIR, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=THUMBNAIL_CACHE_DIR, suffix=".tmp")
+        with os.fdopen(handle, "wb") as image:
+            image.write(png)
+        os.replace(temporary, os.path.join(THUMBNAIL_CACHE_DIR, key + ".png"))
+    except OSError as e:
+        warn("cannot cache the thumbnail: " + str(e))
 
-    out = ""
-    lastcommand = None
-    precision_string = '.' + str(PRECISION) + 'f'
 
-    # the order of parameters
-    # linuxcnc doesn't want K properties on XY plane  Arcs need work.
-    params = ['X', 'Y', 'Z', 'A', 'B', 'C', 'I', 'J', 'F', 'S', 'T', 'Q', 'R', 'L', 'H', 'D', 'P']
-    firstmove = Path.Command("G0", {"X": -1, "Y": -1, "Z": -1, "F": 0.0})
+def export(objectslist, filename, argstring):
+    try:
+        post = SnapmakerPost(argstring)
+    except ValueError as e:
+        err(str(e))
+        return None
+    return post.export(objectslist, filename)
 
-    if hasattr(pathobj, "Group"):  # We have a compound or project.
-        # if OUTPUT_COMMENTS:
-        #     out += linenumber() + "(compound: " + pathobj.Label + ")\n"
-        for p in pathobj.Group:            
-            out += parse(p)
-        return out
-    else:  # parsing simple path
-        log("=== " + pathobj.Name + "===")
-        
-        # groups might contain non-path things like stock.
-        if not hasattr(pathobj, "Path"):
-            return out
 
-        for c in pathobj.Path.Commands:
-            log("Next: " + str(c))
+def emitToolpath(path, filename, argstring):
+    '''Formats a toolpath recorded with --toolpath, see SnapmakerPost.emitToolpath().'''
+    try:
+        post = SnapmakerPost(argstring)
+        return post.emitToolpath(path, filename)
+    except ValueError as e:
+        err(str(e))
+        return None
 
-            outstring = []
-            command = c.Name
 
-            if command[0] == '(':
-                outstring.append(';' + command + '\n')
-                continue
+def pathObjects(pathobj):
+    '''Yields the objects with a Path in pathobj, compounds flattened in order.
+
+    Walks the Groups with an explicit stack of iterators instead of
+    recursion, so compounds can be nested arbitrarily deep.
+    '''
+    stack = [iter((pathobj,))]
+    while stack:
+        for obj in stack[-1]:
+            if hasattr(obj, "Group"):  # We have a compound or project.
+                stack.append(iter(obj.Group))
+                break
+            log("=== %s===", obj.Name)
+            # groups might contain non-path things like stock.
+            if hasattr(obj, "Path"):
+                yield obj
+        else:
+            stack.pop()
+
+
+def operationCommands(pathobj):
+    '''The (name, parameters) of all commands of an operation, compounds flattened.'''
+    return [(c.Name, c.Parameters) for obj in pathObjects(pathobj) for c in obj.Path.Commands]
+
+
+class CoordinateFormat:
+    '''Formats the X, Y, Z and F values of moves with a fixed number of decimals.
+
+    The % templates are built once per precision (see coordinateFormat()),
+    a whole (n, 4) array of values is formatted by a single % operation.
+    With trimZeros every value is followed by END in the templates, so the
+    trailing zeros (X10.500 -> X10.5, X10.000 -> X10) are removed from the
+    finished text by a few str.replace() calls that can't touch anything else.
+    '''
+
+    END = "\x00"
+
+    def __init__(self, precision, trimZeros=False):
+        self.precision = int(precision)
+        self.trim = trimZeros and self.precision > 0
+        self.value = '%.' + str(self.precision) + 'f' + (self.END if self.trim else "")
+        self.move = " X" + self.value + " Y" + self.value + " Z" + self.value + " F" + self.value + "\n"
+        self.templates = {}
+
+    def template(self, command):
+        '''The line template of the command, apply trimmed() to the result.'''
+        template = self.templates.get(command)
+        if template is None:
+            template = self.templates[command] = command + self.move
+        return template
+
+    def values(self, values):
+        '''The formatted values of a flat sequence of floats.'''
+        text = (self.value + " ") * len(values) % tuple(values)
+        return self.trimmed(text).split()
+
+    def line(self, command, x, y, z, feedrate):
+        return self.trimmed(self.template(command) % (x, y, z, feedrate))
+
+    def lines(self, command, values):
+        '''The lines of a (n, 4) array of X, Y, Z, F values.'''
+        return self.trimmed(self.template(command) * len(values) % tuple(values.ravel().tolist()))
+
+    def trimmed(self, text):
+        '''Removes the trailing zeros of the values in text formatted with a template.'''
+        if not self.trim:
+            return text
+        end = self.END
+        # every value has exactly precision decimals, so removing at most
+        # precision - 1 zeros (in decreasing runs) stops at the decimal point
+        for zeros in range(self.precision - 1, 0, -1):
+            text = text.replace("0" * zeros + end, end)
+        text = text.replace(".0" + end, end).replace("." + end, end)
+        return text.replace("-0" + end, "0").replace(end, "")
+
+
+@functools.lru_cache(maxsize=None)
+def coordinateFormat(precision, trimZeros=False):
+    '''The shared CoordinateFormat of a precision.'''
+    return CoordinateFormat(precision, trimZeros)
+
+
+def createCommand(ctx, command, x, y, z, feedrate):
+    post = ctx.post
+    coordinates = post.coordinateFormat
+
+    x = float(x)
+    y = float(y)
+    z = float(z)
+    feedrate = float(feedrate)
+    violations = ctx.violations
+    if violations.checkPoints and violations.check(np.array([[x, y, z]]), np.array([feedrate])) is not None:
+        violations.add(violations.nextLine(), violations.describe((x, y, z), feedrate))
+    ctx.boundary.add(x, y, z)
+    ctx.estimator.add(x, y, z, feedrate)
+    if ctx.toolpath is not None:
+        ctx.toolpath.add(TOOLPATH_RAPID if command == "G0" else TOOLPATH_LINEAR, x, y, z, feedrate)
+    if ctx.preview is not None:
+        ctx.preview.add(x, y, z)
+
+    if post.modal or not post.outputDoubles:
+        return ctx.modal.line(command, coordinates.values((x, y, z, feedrate)))
+    return ctx.linenumber() + coordinates.line(command, x, y, z, feedrate)
+
+def createCommands(ctx, command, points, feedrates):
+    '''Formats a (n, 3) array of points in bulk, see createCommand().'''
+    started = time.perf_counter()
+    ctx.boundary.addPoints(points)
+    ctx.estimator.addPoints(points, feedrates)
+    if ctx.preview is not None:
+        ctx.preview.addPoints(points)
+    if ctx.toolpath is not None:
+        ctx.toolpath.addPoints(TOOLPATH_RAPID if command == "G0" else TOOLPATH_LINEAR, points, feedrates)
+    violating = ctx.violations.check(points, feedrates) if ctx.violations.checkPoints else None
+    if violating is not None:
+        ctx.violations.addPoints(ctx, points, feedrates, violating)
+    formatting = time.perf_counter()
+    ctx.profile.seconds["bounds"] += formatting - started
+    ctx.profile.counts["points"] += len(points)
+    text = formatCommands(ctx, command, points, feedrates)
+    ctx.profile.seconds["format"] += time.perf_counter() - formatting
+    return text
+
+def formatCommands(ctx, command, points, feedrates):
+    post = ctx.post
+    coordinates = post.coordinateFormat
+    values = np.column_stack((points, feedrates))
+    if post.modal or not post.outputDoubles:
+        formatted = coordinates.values(values.ravel().tolist())
+        return "".join([ctx.modal.line(command, formatted[i:i + 4]) for i in range(0, len(formatted), 4)])
+    if post.outputLineNumbers:
+        template = coordinates.template(command)
+        return coordinates.trimmed("".join([ctx.linenumber() + template % tuple(row) for row in values.tolist()]))
+    return coordinates.lines(command, values)
+
+def createNoPosCommand(ctx, command, params):
+    return ctx.linenumber() + "{command} {params}\n".format(command=command, params=params)
+
+def emitRecords(ctx, records, text):
+    '''Writes toolpath records of an operation to ctx.output like parse() wrote them.
+
+    Points go through createCommands() in runs of the same command, so the
+    boundary, time, preview and validation are computed as when posting.
+    '''
+    commands = records["command"]
+    runStarts = np.flatnonzero(commands[1:] != commands[:-1]) + 1
+    bounds = np.concatenate(([0], runStarts, [len(records)])).tolist()
+    for first, last in zip(bounds[:-1], bounds[1:]):
+        command = int(commands[first])
+        if command == TOOLPATH_RAPID or command == TOOLPATH_LINEAR:
+            name = "G0" if command == TOOLPATH_RAPID else "G1"
+            for chunk in range(first, last, TOOLPATH_CHUNK):
+                run = records[chunk:min(chunk + TOOLPATH_CHUNK, last)]
+                points = np.column_stack((run["x"], run["y"], run["z"]))
+                ctx.output.write(createCommands(ctx, name, points, run["f"]))
+            end = records[last - 1]
+            ctx.position = FreeCAD.Vector(float(end["x"]), float(end["y"]), float(end["z"]))
+            continue
+        for record in records[first:last]:
+            if command == TOOLPATH_DWELL:
+                dwellTimeMs = float(record["x"])
+                ctx.estimator.dwell(dwellTimeMs / 1000)
+                ctx.output.write(createNoPosCommand(ctx, "G4", "P" + str(dwellTimeMs)))
+                if ctx.toolpath is not None:
+                    ctx.toolpath.add(TOOLPATH_DWELL, dwellTimeMs)
+            elif command == TOOLPATH_RESET:
+                ctx.modal.reset()
+                if ctx.toolpath is not None:
+                    ctx.toolpath.add(TOOLPATH_RESET)
+            elif command == TOOLPATH_SPINDLE:
+                spindleOn(ctx, int(record["x"]))
+            elif command == TOOLPATH_TEXT:
+                lines = toolpathText(text, record)
+                if not lines:
+                    ctx.linenumber()  # messages take a line number without output
+                ctx.output.write("".join([ctx.linenumber() + line for line in lines.splitlines(True)]))
+                if ctx.toolpath is not None:
+                    ctx.toolpath.addText(lines)
+    ctx.profile.counts["operations"] += 1
+
+
+# Move kinds collected by MoveBatch
+MOVE_STRAIGHT = 0  # emitted as its end point only
+MOVE_STRAIGHT_BROKEN = 1  # broken into segments (--break-straight)
+MOVE_ARC_CW = 2
+MOVE_ARC_CCW = 3
+MOVE_RAPID = 4  # emitted as a G0 to its end point (--rapids)
+
+MOVE_BATCH_SIZE = 1024  # moves discretized and formatted at once
+
+
+class MoveBatch:
+    '''Straight and circular moves waiting to be discretized together.
+
+    Arc points are computed directly from start point, centre, end point and
+    direction for the whole batch with NumPy, then formatted in bulk. Moves
+    must be flushed before any other output is written to keep the order.
+    '''
+
+    def __init__(self):
+        self.kinds = []
+        self.starts = []
+        self.ends = []
+        self.centers = []
+        self.feedrates = []
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def add(self, kind, start, end, center, feedrate):
+        self.kinds.append(kind)
+        self.starts.append(start)
+        self.ends.append(end)
+        self.centers.append(center)
+        self.feedrates.append(feedrate)
+
+    def discretize(self, post):
+        '''Returns the (n, 3) points, the feedrate of every point and whether it is a rapid.'''
+        kinds = np.array(self.kinds)
+        starts = np.array(self.starts, dtype=float)
+        ends = np.array(self.ends, dtype=float)
+        centers = np.array(self.centers, dtype=float)
+        deltas = ends - starts
+
+        # sweep angle of the arcs, coinciding end points make a full circle
+        fromCenter = starts[:, :2] - centers[:, :2]
+        toCenter = ends[:, :2] - centers[:, :2]
+        radius = np.hypot(fromCenter[:, 0], fromCenter[:, 1])
+        startAngle = np.arctan2(fromCenter[:, 1], fromCenter[:, 0])
+        endAngle = np.arctan2(toCenter[:, 1], toCenter[:, 0])
+        fullCircle = np.hypot(deltas[:, 0], deltas[:, 1]) <= PathGeom.Tolerance
+        sweepCCW = np.where(fullCircle, 2 * math.pi, (endAngle - startAngle) % (2 * math.pi))
+        sweepCW = np.where(fullCircle, 2 * math.pi, (startAngle - endAngle) % (2 * math.pi))
+        sweep = np.where(kinds == MOVE_ARC_CCW, sweepCCW, -sweepCW)
+
+        isArc = (kinds == MOVE_ARC_CW) | (kinds == MOVE_ARC_CCW)
+        length = np.where(isArc,
+                          np.hypot(radius * np.abs(sweep), deltas[:, 2]),
+                          np.sqrt((deltas * deltas).sum(axis=1)))
+        counts = np.maximum(np.ceil(length * (post.segmentsPerCm / 10)), 1).astype(np.int64)
+        counts[(kinds == MOVE_STRAIGHT) | (kinds == MOVE_RAPID)] = 1
+        if post.chordTolerance is not None:
+            # largest segment angle whose sagitta r * (1 - cos(angle / 2)) stays within the tolerance
+            ratio = 1 - post.chordTolerance / np.maximum(radius, PathGeom.Tolerance)
+            segmentAngle = np.minimum(2 * np.arccos(np.clip(ratio, -1, 1)), MAX_CHORD_ANGLE)
+            arcCounts = np.maximum(np.ceil(np.abs(sweep) / segmentAngle), 1).astype(np.int64)
+            counts = np.where(isArc, arcCounts, counts)
+
+        # parameter t in (0, 1] of every point along its move
+        owner = np.repeat(np.arange(len(kinds)), counts)
+        lastIndex = np.cumsum(counts) - 1
+        step = np.arange(len(owner)) - (lastIndex - counts + 1)[owner] + 1
+        t = step / counts[owner]
+
+        points = starts[owner] + deltas[owner] * t[:, None]
+        onArc = isArc[owner]
+        if onArc.any():
+            arcOwner = owner[onArc]
+            angle = startAngle[arcOwner] + sweep[arcOwner] * t[onArc]
+            points[onArc, 0] = centers[arcOwner, 0] + radius[arcOwner] * np.cos(angle)
+            points[onArc, 1] = centers[arcOwner, 1] + radius[arcOwner] * np.sin(angle)
+        points[lastIndex] = ends
+
+        return points, np.array(self.feedrates, dtype=float)[owner], (kinds == MOVE_RAPID)[owner]
+
+    def flush(self, ctx):
+        if not self.kinds:
+            return
+        started = time.perf_counter()
+        points, feedrates, rapid = self.discretize(ctx.post)
+        log(" ▶ broke %d moves into %d segments", len(self.kinds), len(points))
+        if ctx.post.simplifyTolerance is not None:
+            keep = simplifyPoints(np.array(self.starts[0], dtype=float), points, feedrates,
+                                  ctx.post.simplifyTolerance, ctx.post.precision, rapid)
+            ctx.simplify.moves += len(points)
+            ctx.simplify.removed += len(points) - int(keep.sum())
+            points = points[keep]
+            feedrates = feedrates[keep]
+            rapid = rapid[keep]
+        ctx.profile.seconds["discretize"] += time.perf_counter() - started
+        ctx.profile.counts["moves"] += len(self.kinds)
+        ctx.profile.counts["batches"] += 1
+        # rapids and cutting moves are formatted in runs of the same command
+        runStarts = np.concatenate(([0], np.flatnonzero(rapid[1:] != rapid[:-1]) + 1, [len(points)]))
+        for first, last in zip(runStarts[:-1], runStarts[1:]):
+            command = "G0" if rapid[first] else "G1"
+            ctx.output.write(createCommands(ctx, command, points[first:last], feedrates[first:last]))
+        self.__init__()
+
+
+def segmentDistances(points, start, end):
+    '''Distances of the points from the segment start -> end.'''
+    direction = end - start
+    lengthSquared = float(np.dot(direction, direction))
+    offsets = points - start
+    if lengthSquared == 0:
+        return np.sqrt((offsets * offsets).sum(axis=1))
+    t = np.clip(offsets.dot(direction) / lengthSquared, 0, 1)
+    deviation = offsets - t[:, None] * direction
+    return np.sqrt((deviation * deviation).sum(axis=1))
+
+
+def simplifyPoints(anchor, points, feedrates, tolerance, precision, rapid=None):
+    '''Returns a mask of the points to keep when simplifying the polyline.
+
+    The polyline starts at the anchor, the position before the first point.
+    Points that repeat their predecessor at the output precision (number of
+    decimals) are dropped,
+    then every run of points with the same feedrate (and the same command
+    if rapid flags the G0 points) is simplified with Ramer-Douglas-Peucker.
+    The last point of a run is always kept, so feedrate changes happen at
+    the same place as before.
+    '''
+    decimals = int(precision)
+    rounded = np.round(points, decimals)
+    previous = np.vstack((np.round(anchor, decimals), rounded[:-1]))
+    keep = (rounded != previous).any(axis=1)
+
+    changes = feedrates[1:] != feedrates[:-1]
+    if rapid is not None:
+        changes |= rapid[1:] != rapid[:-1]
+    runEnds = np.flatnonzero(changes)
+    runEnds = np.append(runEnds, len(points) - 1)
+    runStart = 0
+    for runEnd in runEnds:
+        runEnd = int(runEnd)
+        run = np.flatnonzero(keep[runStart:runEnd + 1]) + runStart
+        if len(run):
+            # the last point of the run may only be dropped as a duplicate
+            line = np.vstack((anchor, points[run]))
+            stack = [(0, len(line) - 1)]
+            mask = np.zeros(len(line), dtype=bool)
+            mask[-1] = True
+            while stack:
+                first, last = stack.pop()
+                if last - first < 2:
+                    continue
+                distances = segmentDistances(line[first + 1:last], line[first], line[last])
+                farthest = int(np.argmax(distances))
+                if distances[farthest] > tolerance:
+                    index = first + 1 + farthest
+                    mask[index] = True
+                    stack.append((first, index))
+                    stack.append((index, last))
+            keep[run] = mask[1:]
+            anchor = points[run[-1]]
+        runStart = runEnd + 1
+
+    return keep
+
+
+@functools.lru_cache(maxsize=1024)
+def convertFeedrate(feedrate, speedFormat):
+    '''A Path feedrate (mm/s) in speedFormat, 0 unless positive.
+
+    Jobs use few distinct feedrates, so FreeCAD's unit conversion runs once
+    per value and unit system instead of once per command.
+    '''
+    speed = Units.Quantity(feedrate, FreeCAD.Units.Velocity)
+    converted = float(speed.getValueAs(speedFormat))
+    return converted if converted > 0.0 else 0
+
+def updateFeedrates(ctx, params, debug=False):
+    '''Find feedrate and assign to either horizontal or vertical speed.
+
+    New feedrates are logged if debug is set, see debugging().
+    '''
+    if P_FEEDRATE in params:
+        feedrateString = convertFeedrate(params[P_FEEDRATE], ctx.speedFormat)
+
+        if feedrateString > 0:
+            if P_POSITION_Z in params:
+                if not params[P_POSITION_Z] == ctx.position.z:
+                    if debug and not ctx.feedrateVertical == feedrateString:
+                        log("New Vertical Feedrate %s", feedrateString)
+                    ctx.feedrateVertical = feedrateString
+                else:
+                    if debug and not ctx.feedrateHorizontal == feedrateString:
+                        log("New Horizontal Feedrate %s", feedrateString)
+                    ctx.feedrateHorizontal = feedrateString
 
-            # if modal: suppress the command if it is the same as the last one
-            if MODAL is True:
-                if command == lastcommand:
-                    outstring.pop(0)
-
-            # Find feedrate and assign to either horizontal or vertical speed
-            if P_FEEDRATE in c.Parameters:
-                readFeedrate = c.Parameters[P_FEEDRATE]
-
-                speed = Units.Quantity(readFeedrate, FreeCAD.Units.Velocity)
-                feedrateString = 0
-                if speed.getValueAs(UNIT_SPEED_FORMAT) > 0.0:
-                    feedrateString = float(speed.getValueAs(UNIT_SPEED_FORMAT))
-
-                if feedrateString > 0:
-                    if P_POSITION_Z in c.Parameters:
-                        if not c.Parameters[P_POSITION_Z] == currentHeadPosition.z:
-                            if not feedrateVertical == feedrateString:
-                                log("New Vertical Feedrate " + str(feedrateString))
-                            feedrateVertical = feedrateString                            
-                        else:
-                            if not feedrateHorizontal == feedrateString:
-                                log("New Horizontal Feedrate " + str(feedrateString))
-                            feedrateHorizontal = feedrateString
-                            
-                    else:
-                        feedrateHorizontal = feedrateString
-                        if not feedrateHorizontal == feedrateString:
-                            log("New Horizontal Feedrate " + str(feedrateString))
-                        log("New Horizontal Feedrate " + str(feedrateHorizontal))    
-
-            if command in commandsToSimulate:
-                if command == CMD_HOLE_SIMPLE or command == CMD_HOLE_DWELL or command == CMD_HOLE_PECKED:                   
-                    posX = c.Parameters[P_POSITION_X]
-                    posY = c.Parameters[P_POSITION_Y]
-                    posZ = c.Parameters[P_POSITION_Z]
-                    retractHeight = c.Parameters[P_DRILL_RETRACT_HEIGHT]
-
-                    # In case a pecking statement is provided (usually G83)                    
-                    peckDepth = 0
-                    peckCount = 0
-                    if P_PECK_DEPTH in c.Parameters:
-                        peckDepth = c.Parameters[P_PECK_DEPTH]
-                        totalToDrill = currentHeadPosition.z - posZ
-                        warn("total drill:" +str(totalToDrill)+ " peckDepth: "+str(peckDepth))
-                        peckCount = math.floor(totalToDrill/peckDepth)
-
-                    # In case a dwell statement is provided (G82, G83)
-                    dwellTimeMs = 0
-                    if P_DWELL_MS in c.Parameters:
-                        dwellTimeMs = float(c.Parameters[P_DWELL_MS])
-                    if P_DWELL_S in c.Parameters:
-                        dwellTimeMs = float(c.Parameters[P_DWELL_S] * 1000) 
-
-                    cmdOverHole     = createCommand("G1", posX, posY, currentHeadPosition.z , feedrateHorizontal)
-                    cmdEnteringHole = createCommand("G1", posX, posY, posZ , feedrateVertical)
-                    cmdLeavingHole  = createCommand("G1", posX, posY, retractHeight , feedrateVertical*holeRetractionFactor)                   
-
-                    # move over hole
-                    outstring.append(cmdOverHole)
-
-                    # do pecking moves if parameter was found
-                    if peckCount > 0:
-                        for peckNumber in range(peckCount):
-                            commandPeck = createCommand("G1", posX, posY, currentHeadPosition.z - (peckNumber+1) * peckDepth , feedrateVertical)
-                            outstring.append(commandPeck)
-                            outstring.append(cmdLeavingHole)   
-
-                    # move fully into hole
-                    outstring.append(cmdEnteringHole)
-
-                    # dwell in the finished hole if parameter was found
-                    if dwellTimeMs > 0:
-                        outstring.append(createNoPosCommand("G4","P"+str(dwellTimeMs)))
-
-                    # leave the hole
-                    outstring.append(cmdLeavingHole)      
-
-                    if not moveDrillInRetractHeight:
-                        outstring.append(cmdOverHole)                                              
-
-            elif command in commandsToConvert:
-                edgeOfCommand = PathGeom.edgeForCmd(c, FreeCAD.Vector(currentHeadPosition) )
-
-                if not (edgeOfCommand == None):
-                    requiredPointsForArc = 2 # only two points for all straight commands            
-
-                    #break all non-straight commands
-                    if c.Name not in ["G0", "G00", "G1", "G01"] or BREAK_STRAIGHTS:
-                        requiredPointsForArc = 1 + math.ceil(edgeOfCommand.Length * (SEGMENTS_PER_CM_ARC / 10))
-
-                    discretePoints = edgeOfCommand.copy().discretize(requiredPointsForArc)
-
-                    for p in discretePoints[1:]:
-                        # segmentCommand = "G1 X"+str(p.x)+" Y"+str(p.y)+" Z"+str(p.z)+"\n"
-
-                        adaptiveFeedrate = min(feedrateVertical, feedrateHorizontal)
-                        if P_POSITION_Z in c.Parameters:
-                            posZ = c.Parameters[P_POSITION_Z]
-                            if posZ == currentHeadPosition.z:
-                                adaptiveFeedrate = feedrateHorizontal
-                        else:
-                            adaptiveFeedrate = feedrateHorizontal
-
-                        segmentCommand = createCommand("G1",p.x, p.y, p.z, adaptiveFeedrate)
-                        #log(segmentCommand)
-                        outstring.append(segmentCommand)
-                    log(" ▶ broke shape into " + str(len(discretePoints)) + " segments")
-            elif command == CMD_SPINDLE_ON:
-                rpmSet = int(c.Parameters[P_SPINDLE_RPM])
-                powerToSet = rpmSet / TOOLHEAD.maxSpindleRPM * TOOLHEAD.maxSpindlePower
-                if powerToSet < TOOLHEAD.minSpindlePower:
-                    powerToSet = TOOLHEAD.minSpindlePower
-                if powerToSet > TOOLHEAD.maxSpindlePower:
-                    powerToSet = TOOLHEAD.maxSpindlePower 
-                outstring.append(createNoPosCommand(CMD_SPINDLE_ON, P_SPINDLE_POWER + str(powerToSet)))
             else:
-                outstring.append(command)     
-
-            #remember the last position moved to
-            if not (command == CMD_HOLE_SIMPLE or command == CMD_HOLE_DWELL or command == CMD_HOLE_PECKED):
-                for param in c.Parameters:
-                    if param == "X":
-                        currentHeadPosition.x = c.Parameters[param]
-                    if param == "Y":
-                        currentHeadPosition.y = c.Parameters[param]
-                    if param == "Z":
-                        currentHeadPosition.z = c.Parameters[param]
+                ctx.feedrateHorizontal = feedrateString
+                if debug:
+                    log("New Horizontal Feedrate %s", ctx.feedrateHorizontal)
+
+
+def updatePosition(ctx, command, params):
+    '''Remember the last position moved to.'''
+    position = ctx.position
+    posX = params.get(P_POSITION_X)
+    if posX is not None:
+        position.x = posX
+    posY = params.get(P_POSITION_Y)
+    if posY is not None:
+        position.y = posY
+    if command in commandsHoles:
+        if moveDrillInRetractHeight:
+            position.z = params[P_DRILL_RETRACT_HEIGHT]
+    else:
+        posZ = params.get(P_POSITION_Z)
+        if posZ is not None:
+            position.z = posZ
+
+
+def drillTemplate(ctx, command, params):
+    '''Z and feedrate of the moves simulating a drilling cycle, the same for every hole.
+
+    Returns the (z, feedrate, kind) rows before the dwell, the dwell in ms
+    and the rows after it. With --rapids the moves over the hole and the
+    retracts are rapids at the jog speed. Templates are kept in ctx.drillTemplates, keyed by the
+    parameters besides X and Y, the head height and the feedrates.
+    '''
+    key = (command, holeKey(params), ctx.position.z, ctx.feedrateHorizontal, ctx.feedrateVertical)
+    template = ctx.drillTemplates.get(key)
+    if template is not None:
+        return template
+
+    headZ = ctx.position.z
+    posZ = params[P_POSITION_Z]
+    retractHeight = params[P_DRILL_RETRACT_HEIGHT]
+    overHole = (headZ, ctx.feedrateHorizontal, MOVE_STRAIGHT)
+    enteringHole = (posZ, ctx.feedrateVertical, MOVE_STRAIGHT)
+    leavingHole = (retractHeight, ctx.feedrateVertical * holeRetractionFactor, MOVE_STRAIGHT)
+    if ctx.post.jogSpeed is not None:
+        overHole = (headZ, ctx.post.jogSpeed, MOVE_RAPID)
+        leavingHole = (retractHeight, ctx.post.jogSpeed, MOVE_RAPID)
+
+    # move over hole
+    before = [overHole]
+
+    # In case a pecking statement is provided (usually G83)
+    if P_PECK_DEPTH in params:
+        peckDepth = params[P_PECK_DEPTH]
+        totalToDrill = headZ - posZ
+        warn("total drill:" + str(totalToDrill) + " peckDepth: " + str(peckDepth))
+        for peckNumber in range(math.floor(totalToDrill / peckDepth)):
+            before.append((headZ - (peckNumber + 1) * peckDepth, ctx.feedrateVertical, MOVE_STRAIGHT))
+            before.append(leavingHole)
+
+    # move fully into hole
+    before.append(enteringHole)
+
+    # In case a dwell statement is provided (G82, G83)
+    dwellTimeMs = 0
+    if P_DWELL_MS in params:
+        dwellTimeMs = float(params[P_DWELL_MS])
+    if P_DWELL_S in params:
+        dwellTimeMs = float(params[P_DWELL_S] * 1000)
+
+    # leave the hole
+    after = [leavingHole]
+    if not moveDrillInRetractHeight:
+        after.append(overHole)
+
+    template = ctx.drillTemplates[key] = (before, dwellTimeMs, after)
+    return template
+
+
+def holeKey(params):
+    '''The parameters of a drilling command besides the hole position.'''
+    return tuple(sorted((name, value) for name, value in params.items() if name != P_POSITION_X and name != P_POSITION_Y))
+
+
+def holeUnit(commands, i):
+    '''Index of the first command from commands[i] on that is no rapid or comment.
+
+    A hole is a drilling command with the rapids (and comments) before it
+    positioning the head over it, as FreeCAD's drilling operation emits them.
+    Returns the index and if a hole ends with the command there.
+    '''
+    j = i
+    while j < len(commands) and (commands[j][0] in commandsRapid or commands[j][0][0] == '('):
+        j += 1
+    return j, j < len(commands) and commands[j][0] in commandsHoles
+
+
+def orderHoles(ctx):
+    '''Reorders the holes of ctx.commands to shorten the travel between them.
+
+    Runs of holes whose drilling commands only differ in X and Y are ordered
+    nearest neighbour first, starting at the head position, and improved
+    with 2-opt. The rapids positioning the head over a moved hole are
+    rebuilt: up to the height the head travelled at before the n-th hole of
+    the run, over the hole and down to the height the hole was drilled from.
+    Commands around a run keep their place, so the head leaves the last hole
+    of a run to the same next command as before.
+    '''
+    scan = OperationContext(ctx.post, ctx.label, None, ctx.position, ctx.feedrateHorizontal, ctx.feedrateVertical, ctx.speedFormat, ctx.linenumber)
+    commands = ctx.commands
+    positions = []  # head position after every command
+    for command, params in commands:
+        if command[0] != '(':
+            updateFeedrates(scan, params)
+            updatePosition(scan, command, params)
+        positions.append((scan.position.x, scan.position.y, scan.position.z))
+
+    def positionBefore(index):
+        return positions[index - 1] if index > 0 else (ctx.position.x, ctx.position.y, ctx.position.z)
+
+    ordered = []
+    i = 0
+    while i < len(commands):
+        cycle, isHole = holeUnit(commands, i)
+        if not isHole:
+            end = max(cycle, i + 1)
+            ordered.extend(commands[i:end])
+            i = end
+            continue
+        command, params = commands[cycle]
+        key = holeKey(params)
+        units = [(i, cycle)]  # (first command, drilling command) of every hole in the run
+        while True:
+            cycle, isHole = holeUnit(commands, units[-1][1] + 1)
+            if not isHole or commands[cycle][0] != command or holeKey(commands[cycle][1]) != key:
+                break
+            units.append((units[-1][1] + 1, cycle))
+        order = list(range(len(units)))
+        if len(units) > 1:
+            start = np.array(positionBefore(units[0][0])[:2], dtype=float)
+            holes = np.array([positions[cycle][:2] for _, cycle in units], dtype=float)
+            order = nearestNeighbourOrder(start, holes)
+            if len(units) <= HOLE_2OPT_LIMIT:
+                order = twoOptOrder(start, holes, order)
+            ctx.drilling.count += len(units)
+            ctx.drilling.travelBefore += travelLength(start, holes)
+            ctx.drilling.travelAfter += travelLength(start, holes[order])
+        if list(order) == list(range(len(units))):
+            ordered.extend(commands[units[0][0]:units[-1][1] + 1])
+        else:
+            # holes drilled right after each other keep the rapids before the run in place
+            positioned = any(commands[k][0] in commandsRapid and (n > 0 or P_POSITION_X in commands[k][1] or P_POSITION_Y in commands[k][1])
+                             for n, (first, cycle) in enumerate(units) for k in range(first, cycle))
+            if not positioned:
+                ordered.extend(commands[units[0][0]:units[0][1]])
+            # the height the head travelled at to the n-th hole, before the rapids down over it
+            travels = [max([positionBefore(first)[2]] + [positions[k][2] for k in range(first, cycle) if commands[k][0] in commandsRapid])
+                       for first, cycle in units]
+            z = positionBefore(units[0][0])[2]
+            for travel, k in zip(travels, order):
+                first, cycle = units[k]
+                if positioned:
+                    ordered.extend(c for c in commands[first:cycle] if c[0][0] == '(')
+                    x, y = positions[cycle][:2]
+                    approach = positionBefore(cycle)[2]
+                    if z != travel:
+                        ordered.append((CMD_MOVE_LINEAR_RAPID, {P_POSITION_Z: travel}))
+                    ordered.append((CMD_MOVE_LINEAR_RAPID, {P_POSITION_X: x, P_POSITION_Y: y}))
+                    if approach != travel:
+                        ordered.append((CMD_MOVE_LINEAR_RAPID, {P_POSITION_Z: approach}))
+                ordered.append(commands[cycle])
+                z = positions[cycle][2]
+        i = units[-1][1] + 1
+    ctx.commands = ordered
+
+
+# Command classes of orderContours()
+CONTOUR_COMMENT = 0
+CONTOUR_TRAVEL = 1
+CONTOUR_CUT = 2
+CONTOUR_OTHER = 3
+
+
+def orderContours(ctx):
+    '''Reorders the contours of ctx.commands cut at the same depth to shorten the travel.
+
+    A contour is a block of rapids (G0) followed by a block of cutting moves
+    (G1, G2, G3). Consecutive contours with the same lowest Z are visited
+    nearest neighbour first. Every moved contour starts with a retract to the
+    highest Z of the operation's rapids and a rapid to its entry point before
+    its own rapids, so the tool never travels lower than before. Any other
+    command (spindle, drilling, tool change) stays in place and ends a group.
+    '''
+    scan = OperationContext(ctx.post, ctx.label, None, ctx.position, ctx.feedrateHorizontal, ctx.feedrateVertical, ctx.speedFormat, ctx.linenumber)
+    commands = ctx.commands
+    classes = []
+    positions = []  # head position after every command
+    safeZ = ctx.position.z
+    for command, params in commands:
+        if command[0] == '(':
+            classes.append(CONTOUR_COMMENT)
+        else:
+            updateFeedrates(scan, params)
+            updatePosition(scan, command, params)
+            if command in commandsRapid:
+                classes.append(CONTOUR_TRAVEL)
+                safeZ = max(safeZ, scan.position.z)
+            elif command in commandsStraight or command in commandsArcCW or command in commandsArcCCW:
+                classes.append(CONTOUR_CUT)
             else:
-                for param in c.Parameters:
-                    if param == "X":
-                        currentHeadPosition.x = c.Parameters[param]
-                    if param == "Y":
-                        currentHeadPosition.y = c.Parameters[param]
-                if moveDrillInRetractHeight:
-                    drillRetractHeight = c.Parameters[P_DRILL_RETRACT_HEIGHT]
-                    currentHeadPosition.z = drillRetractHeight
-
-            if command == "message":
-                if OUTPUT_COMMENTS is False:
-                    out = []
-                else:
-                    outstring.pop(0)  # remove the command
-
-            # prepend a line number and append a newline
-            if len(outstring) >= 1:
-                if OUTPUT_LINE_NUMBERS:
-                    outstring.insert(0, (linenumber()))
+                classes.append(CONTOUR_OTHER)
+        positions.append((scan.position.x, scan.position.y, scan.position.z))
+
+    def positionBefore(index):
+        return positions[index - 1] if index > 0 else (ctx.position.x, ctx.position.y, ctx.position.z)
+
+    ordered = []
+    group = []  # (first, cutStart, end, depth) of consecutive contours at the same depth
+
+    def closeGroup():
+        if len(group) > 1:
+            start = np.array(positionBefore(group[0][0])[:2], dtype=float)
+            entries = np.array([positionBefore(cut)[:2] for _, cut, _, _ in group], dtype=float)
+            exits = np.array([positions[end - 1][:2] for _, _, end, _ in group], dtype=float)
+            order = nearestNeighbourOrder(start, entries, exits)
+            ctx.contours.count += len(group)
+            ctx.contours.travelBefore += contourTravel(start, entries, exits)
+            ctx.contours.travelAfter += contourTravel(start, entries[order], exits[order])
+            if list(order) != list(range(len(group))):
+                for k in order:
+                    first, cut, end, _ = group[k]
+                    entry = positionBefore(cut)
+                    ordered.append((CMD_MOVE_LINEAR_RAPID, {P_POSITION_Z: safeZ}))
+                    ordered.append((CMD_MOVE_LINEAR_RAPID, {P_POSITION_X: entry[0], P_POSITION_Y: entry[1]}))
+                    ordered.extend(commands[first:end])
+                group.clear()
+                return
+        for first, _, end, _ in group:
+            ordered.extend(commands[first:end])
+        group.clear()
+
+    i = 0
+    while i < len(commands):
+        if classes[i] == CONTOUR_TRAVEL:
+            cut = i
+            while cut < len(commands) and classes[cut] in (CONTOUR_TRAVEL, CONTOUR_COMMENT):
+                cut += 1
+            end = cut
+            while end < len(commands) and classes[end] in (CONTOUR_CUT, CONTOUR_COMMENT):
+                end += 1
+            if CONTOUR_CUT in classes[cut:end]:
+                depth = round(min(positions[k][2] for k in range(cut, end)), 6)
+                if group and group[-1][3] != depth:
+                    closeGroup()
+                group.append((i, cut, end, depth))
+                i = end
+                continue
+            closeGroup()
+            ordered.extend(commands[i:cut])
+            i = cut
+            continue
+        closeGroup()
+        ordered.append(commands[i])
+        i += 1
+    closeGroup()
+    ctx.commands = ordered
+
+
+def contourTravel(start, entries, exits):
+    '''Length of the travel from start through the contours in order.'''
+    froms = np.vstack((start, exits[:-1]))
+    return float(np.sqrt(((entries - froms) ** 2).sum(axis=1)).sum())
+
+
+def travelLength(start, points):
+    path = np.vstack((start, points))
+    return float(np.sqrt((np.diff(path, axis=0) ** 2).sum(axis=1)).sum())
+
+
+def nearestNeighbourOrder(start, points, exits=None):
+    '''Indices of the points, always going to the closest one not visited yet.
+
+    With exits the path continues from the exit of the visited point (the
+    end of a contour) instead of the point itself.
+    '''
+    if exits is None:
+        exits = points
+    remaining = np.ones(len(points), dtype=bool)
+    order = []
+    current = start
+    for _ in range(len(points)):
+        distances = ((points - current) ** 2).sum(axis=1)
+        distances[~remaining] = np.inf
+        k = int(np.argmin(distances))
+        order.append(k)
+        remaining[k] = False
+        current = exits[k]
+    return np.array(order)
+
+
+def twoOptOrder(start, points, order):
+    '''Improves the open path from start through the points in order by 2-opt.
+
+    The best reversal of path[i:j + 1] is searched for every i with NumPy,
+    until a pass finds no improvement or HOLE_2OPT_PASSES passes are done.
+    '''
+    path = np.vstack((start, points[order]))
+    indices = np.concatenate(([-1], order))
+    n = len(path)
+    for _ in range(HOLE_2OPT_PASSES):
+        improved = False
+        for i in range(1, n - 1):
+            a = path[i - 1]
+            b = path[i]
+            c = path[i + 1:]  # candidate ends j = i + 1 .. n - 1
+            d = path[i + 2:]
+            ab = np.hypot(*(b - a))
+            ac = np.hypot(c[:, 0] - a[0], c[:, 1] - a[1])
+            bd = np.append(np.hypot(d[:, 0] - b[0], d[:, 1] - b[1]), 0)
+            cd = np.append(np.hypot(d[:, 0] - c[:-1, 0], d[:, 1] - c[:-1, 1]), 0)
+            delta = ac + bd - ab - cd
+            k = int(np.argmin(delta))
+            if delta[k] < -1e-9:
+                j = i + 1 + k
+                path[i:j + 1] = path[i:j + 1][::-1].copy()
+                indices[i:j + 1] = indices[i:j + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return indices[1:]
+
+
+def spindlePower(rpm, maxSpindleRPM, minSpindlePower, maxSpindlePower):
+    '''Power (percent) of M3 for the spindle RPM.'''
+    power = rpm / maxSpindleRPM * maxSpindlePower
+    if power < minSpindlePower:
+        power = minSpindlePower
+    if power > maxSpindlePower:
+        power = maxSpindlePower
+    return power
+
+
+@functools.lru_cache(maxsize=None)
+def spindlePowerTable(maxSpindleRPM, minSpindlePower, maxSpindlePower):
+    '''spindlePower() of every RPM from 0 to the maximum, computed once per toolhead.'''
+    return tuple(spindlePower(rpm, maxSpindleRPM, minSpindlePower, maxSpindlePower) for rpm in range(int(maxSpindleRPM) + 1))
+
+
+# Command handlers of parse(), see COMMAND_HANDLERS. A handler gets the
+# context, the MoveBatch, the command name and its parameters after the
+# feedrates were updated and before the head position is. It returns the
+# text to write or None. Handlers of straight moves, arcs and holes add to the
+# batch, all others flush it first since they take line numbers or write.
+
+
+def moveFeedrate(ctx, params):
+    '''Horizontal feedrate, unless the move changes the height.'''
+    posZ = params.get(P_POSITION_Z)
+    if posZ is None or posZ == ctx.position.z:
+        return ctx.feedrateHorizontal
+    return min(ctx.feedrateVertical, ctx.feedrateHorizontal)
+
+
+def moveEnds(ctx, params):
+    '''Start and end point of a move from the head position.'''
+    position = ctx.position
+    start = (position.x, position.y, position.z)
+    end = (params.get(P_POSITION_X, start[0]),
+           params.get(P_POSITION_Y, start[1]),
+           params.get(P_POSITION_Z, start[2]))
+    return start, end
+
+
+def batchMove(ctx, moves, kind, start, end, center, feedrate):
+    '''Adds a move to the batch, flushing full batches.'''
+    moves.add(kind, start, end, center, feedrate)
+    if len(moves) >= MOVE_BATCH_SIZE:
+        moves.flush(ctx)
+
+
+def coincide(start, end):
+    '''True if the points are the same within PathGeom.Tolerance, like PathGeom.pointsCoincide() without Vectors.'''
+    tolerance = PathGeom.Tolerance
+    return abs(start[0] - end[0]) <= tolerance and abs(start[1] - end[1]) <= tolerance and abs(start[2] - end[2]) <= tolerance
+
+
+def parseStraight(ctx, moves, command, params):
+    '''G1, broken into segments with --break-straight.'''
+    start, end = moveEnds(ctx, params)
+    if coincide(start, end):
+        return None  # nothing to move
+    kind = MOVE_STRAIGHT_BROKEN if ctx.post.breakStraights else MOVE_STRAIGHT
+    batchMove(ctx, moves, kind, start, end, start, moveFeedrate(ctx, params))
+
+
+def parseRapid(ctx, moves, command, params):
+    '''G0, a G1 unless --rapids is given.'''
+    jogSpeed = ctx.post.jogSpeed
+    if jogSpeed is None:
+        return parseStraight(ctx, moves, command, params)
+    start, end = moveEnds(ctx, params)
+    if coincide(start, end):
+        return None
+    batchMove(ctx, moves, MOVE_RAPID, start, end, start, jogSpeed)
+
+
+def addArc(ctx, moves, kind, params):
+    '''Adds a G2/G3 around the centre given by I, J and K relative to the head.'''
+    start, end = moveEnds(ctx, params)
+    center = (start[0] + params.get('I', 0),
+              start[1] + params.get('J', 0),
+              start[2] + params.get('K', 0))
+    batchMove(ctx, moves, kind, start, end, center, moveFeedrate(ctx, params))
+
+
+def parseArcCW(ctx, moves, command, params):
+    addArc(ctx, moves, MOVE_ARC_CW, params)
+
+
+def parseArcCCW(ctx, moves, command, params):
+    addArc(ctx, moves, MOVE_ARC_CCW, params)
+
+
+def parseHole(ctx, moves, command, params):
+    '''G81, G82 and G83, simulated by moves from the drillTemplate().'''
+    posX = params[P_POSITION_X]
+    posY = params[P_POSITION_Y]
+    before, dwellTimeMs, after = drillTemplate(ctx, command, params)
+
+    # the moves of the hole go through the batch like any straight move
+    position = ctx.position
+    start = (position.x, position.y, position.z)
+    for rows in (before, after):
+        for posZ, feedrate, kind in rows:
+            end = (posX, posY, posZ)
+            moves.add(kind, start, end, start, feedrate)
+            start = end
+        if rows is before and dwellTimeMs > 0:
+            # dwell in the finished hole
+            moves.flush(ctx)
+            ctx.estimator.dwell(dwellTimeMs / 1000)
+            ctx.output.write(createNoPosCommand(ctx, "G4", "P" + str(dwellTimeMs)))
+            if ctx.toolpath is not None:
+                ctx.toolpath.add(TOOLPATH_DWELL, dwellTimeMs)
+    if len(moves) >= MOVE_BATCH_SIZE:
+        moves.flush(ctx)
+
+
+def parseCurve(ctx, moves, command, params):
+    '''Curves the batched engine does not handle (G5), discretized by FreeCAD.'''
+    moves.flush(ctx)
+    edgeOfCommand = PathGeom.edgeForCmd(Path.Command(command, params), FreeCAD.Vector(ctx.position))
+    if edgeOfCommand is None:
+        return None
 
-                # append the line to the final output
-                for w in outstring:
-                    out += w
-                out = out.strip() + "\n"
+    requiredPointsForArc = 1 + math.ceil(edgeOfCommand.Length * (ctx.post.segmentsPerCm / 10))
+    discretePoints = edgeOfCommand.copy().discretize(requiredPointsForArc)
+    adaptiveFeedrate = moveFeedrate(ctx, params)
+    for p in discretePoints[1:]:
+        ctx.output.write(createCommand(ctx, "G1", p.x, p.y, p.z, adaptiveFeedrate))
+    if debugging():
+        log(" ▶ broke shape into %d segments", len(discretePoints))
+
+
+def parseSpindleOn(ctx, moves, command, params):
+    '''M3 with the RPM mapped to the spindle power of the toolhead.'''
+    moves.flush(ctx)
+    spindleOn(ctx, int(params[P_SPINDLE_RPM]))
+    return None
+
+
+def spindleOn(ctx, rpmSet):
+    '''Writes the M3 for rpmSet, checked against the RPM range of the toolhead.'''
+    toolhead = ctx.post.toolhead
+    if rpmSet and not toolhead.minSpindleRPM <= rpmSet <= toolhead.maxSpindleRPM:
+        ctx.violations.add(ctx.violations.nextLine(), "spindle S%d outside %d-%d RPM of the toolhead" % (rpmSet, toolhead.minSpindleRPM, toolhead.maxSpindleRPM))
+    powers = ctx.post.spindlePowers
+    if 0 <= rpmSet < len(powers):
+        powerToSet = powers[rpmSet]
+    else:
+        powerToSet = spindlePower(rpmSet, toolhead.maxSpindleRPM, toolhead.minSpindlePower, toolhead.maxSpindlePower)
+    ctx.output.write(createNoPosCommand(ctx, CMD_SPINDLE_ON, P_SPINDLE_POWER + str(powerToSet)))
+    if ctx.toolpath is not None:
+        ctx.toolpath.add(TOOLPATH_SPINDLE, rpmSet)
+
+
+def parseOther(ctx, moves, command, params):
+    '''Any other command, passed through without its parameters.'''
+    moves.flush(ctx)
+    line = ctx.linenumber() + command
+    ctx.modal.reset()  # unknown command, don't rely on modal values
+    if ctx.toolpath is not None:
+        ctx.toolpath.add(TOOLPATH_RESET)
+    return line
+
+
+def parseMessage(ctx, moves, command, params):
+    parseOther(ctx, moves, command, params)
+    if ctx.toolpath is not None:
+        ctx.toolpath.addText("")  # the line number taken by the message
+    return None  # messages are never part of the output
+
+
+# Handler of every command name, parseOther() handles the rest. Toolheads
+# can replace or add handlers with a handlers dict, see SnapmakerPost.
+COMMAND_HANDLERS = {
+    CMD_MOVE_LINEAR_RAPID: parseRapid,
+    "G00": parseRapid,
+    CMD_MOVE_LINEAR: parseStraight,
+    "G01": parseStraight,
+    CMD_MOVE_ARC_CW: parseArcCW,
+    "G02": parseArcCW,
+    CMD_MOVE_ARC_CCW: parseArcCCW,
+    "G03": parseArcCCW,
+    CMD_MOVE_BEZIER: parseCurve,
+    CMD_HOLE_SIMPLE: parseHole,
+    CMD_HOLE_DWELL: parseHole,
+    CMD_HOLE_PECKED: parseHole,
+    CMD_SPINDLE_ON: parseSpindleOn,
+    "message": parseMessage,
+}
+
+
+def parse(ctx):
+    '''Generates the body of the operation into ctx.output.'''
+    started = time.perf_counter()
+    written = ctx.output.seconds
+    debug = debugging()
+    moves = MoveBatch()
+    handlers = ctx.post.handlers
+    output = ctx.output
+
+    for command, params in ctx.commands:
+        if debug:
+            log("Next: %s %s", command, params)
+
+        if command[0] == '(':
+            continue
+
+        updateFeedrates(ctx, params, debug)
+        text = handlers.get(command, parseOther)(ctx, moves, command, params)
+        updatePosition(ctx, command, params)
+
+        # append the command's lines to the output
+        if text:
+            text = text.rstrip()
+            if text:
+                moves.flush(ctx)
+                output.write(text + "\n")
+                if ctx.toolpath is not None:
+                    ctx.toolpath.addText(text + "\n")
+
+    moves.flush(ctx)
+
+    profile = ctx.profile
+    profile.counts["operations"] += 1
+    profile.counts["commands"] += len(ctx.commands)
+    nested = profile.seconds["discretize"] + profile.seconds["format"] + profile.seconds["bounds"]
+    profile.seconds["parse"] += time.perf_counter() - started - nested - (ctx.output.seconds - written)
 
-        return out
 
 print(__name__ + " gcode postprocessor loaded.")
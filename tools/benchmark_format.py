@@ -0,0 +1,81 @@
+'''Micro-benchmark of the coordinate formatting of the FreeCAD post.
+
+Formats the same random points the way createCommand() did before the
+CoordinateFormat layer (four format() calls and a str.format per point) and
+with CoordinateFormat, per point and in bulk, with and without
+--trim-zeros:
+
+    python benchmark_format.py --points 200000 --precision 3
+
+The post is imported from FreeCAD's Python, --freecad-lib or else with the
+FreeCAD stand-ins of benchmark_post.py.
+'''
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import benchmark_post
+
+
+def legacyLine(command, x, y, z, feedrate, precision):
+    '''The formatting of createCommand() before CoordinateFormat.'''
+    precision_string = '.' + str(precision) + 'f'
+    xFormatted = format(float(x), precision_string)
+    yFormatted = format(float(y), precision_string)
+    zFormatted = format(float(z), precision_string)
+    feedrateFormatted = format(float(feedrate), precision_string)
+    return "{command} X{x} Y{y} Z{z} F{feedrate}\n".format(command=command, x=xFormatted, y=yFormatted, z=zFormatted, feedrate=feedrateFormatted)
+
+
+def measure(function, repeat):
+    '''Best wall time of repeat runs and the result of the last one.'''
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark_format', description='compare the coordinate formatting of the FreeCAD post')
+    parser.add_argument('--points', type=int, default=200000, help='number of points, default: 200000')
+    parser.add_argument('--precision', type=int, default=3, help='decimals, default: 3')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per variant, the best one counts, default: 3')
+    parser.add_argument('--freecad-lib', help='directory containing FreeCAD.so/FreeCAD.pyd if not on the Python path')
+    args = parser.parse_args(argv)
+
+    post = benchmark_post.importPost(args.freecad_lib)
+
+    # millimetre coordinates on a 0.1 mm grid like typical CAM output, plus arbitrary ones
+    generator = np.random.default_rng(1)
+    values = np.empty((args.points, 4))
+    values[:, :3] = generator.uniform(-50, 300, (args.points, 3))
+    values[::2, :3] = np.round(values[::2, :3], 1)
+    values[:, 3] = generator.choice([300.0, 600.0, 1200.0], args.points)
+    rows = values.tolist()
+
+    plain = post.CoordinateFormat(args.precision)
+    trimming = post.CoordinateFormat(args.precision, trimZeros=True)
+    variants = [
+        ("legacy per point", lambda: "".join([legacyLine("G1", x, y, z, f, args.precision) for x, y, z, f in rows])),
+        ("per point", lambda: "".join([plain.line("G1", x, y, z, f) for x, y, z, f in rows])),
+        ("bulk", lambda: plain.lines("G1", values)),
+        ("bulk, trim zeros", lambda: trimming.lines("G1", values)),
+    ]
+
+    baseline = None
+    print("%d points, precision %d" % (args.points, args.precision))
+    for name, function in variants:
+        seconds, text = measure(function, args.repeat)
+        baseline = baseline or seconds
+        print("  %-18s %8.3f s %10.0f points/s %6.1fx %6.1f bytes/line" % (
+            name, seconds, args.points / seconds, baseline / seconds, len(text) / args.points))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
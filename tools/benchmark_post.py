@@ -0,0 +1,334 @@
+'''Throughput benchmark of the FreeCAD post on synthetic jobs.
+
+Every job is posted with every set of post options, each in a fresh Python
+process, and measured for lines/s, peak memory and output size. The best of
+--repeat runs counts:
+
+    python benchmark_post.py --scale 0.1
+    python benchmark_post.py --jobs arcs adaptive --options default="" simplify="--simplify 0.01"
+    python benchmark_post.py --json before.json
+    python benchmark_post.py --baseline before.json
+
+Without FreeCAD on the Python path the stand-ins in freecad_stand_ins/ are
+used, so the benchmark runs with a plain Python and NumPy. With --baseline
+cases that got slower or bigger in memory than the tolerance are reported
+and the exit code is 1.
+'''
+import argparse
+import contextlib
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+TOOLS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+POST_DIRECTORY = os.path.join(TOOLS_DIRECTORY, os.pardir, "assets", "snapmaker-freecad-configuration")
+STAND_INS_DIRECTORY = os.path.join(TOOLS_DIRECTORY, "freecad_stand_ins")
+
+# post options every job is posted with, by name
+OPTIONS = {
+    "default": "",
+    "modal": "--modal --axis-modal",
+    "trim-zeros": "--trim-zeros",
+    "simplify": "--simplify 0.01",
+    "chord-tolerance": "--chord-tolerance 0.01",
+    "line-numbers": "--line-numbers",
+    "threads": "--threads 4",
+    "ordering": "--rapids --order-holes --order-contours",
+    "no-thumbnail": "--no-thumbnail",
+}
+
+# Allowed change against --baseline before a case counts as regression
+TOLERANCE = 0.1  # relative
+
+RESULT_COLUMNS = ["job", "options", "commands", "lines", "bytes", "seconds", "lines_per_s", "peak_mb", "post_mb"]
+
+
+def importPost(freecadLib=None):
+    '''Imports the post, from FreeCAD's modules or else the stand-ins.'''
+    if freecadLib:
+        sys.path.insert(0, freecadLib)
+    try:
+        import FreeCAD  # noqa: F401 pylint: disable=unused-import,import-outside-toplevel
+    except ImportError:
+        sys.path.insert(0, STAND_INS_DIRECTORY)
+    sys.path.insert(0, POST_DIRECTORY)
+    with contextlib.redirect_stdout(sys.stderr):
+        import snapmaker_freecad_post  # pylint: disable=import-outside-toplevel
+    return snapmaker_freecad_post
+
+
+class Operation:
+    '''Synthetic Path operation, or compound with a Group of operations.'''
+
+    def __init__(self, label, commands=(), group=None):
+        import Path  # pylint: disable=import-outside-toplevel
+        self.Name = self.Label = label
+        self.Path = Path.Path(commands)
+        if group is not None:
+            self.Group = group
+
+
+def arcsJob(scale):
+    '''Pockets of concentric full circles (G2/G3 with I, J), spindle on and off.'''
+    from Path import Command  # pylint: disable=import-outside-toplevel
+    operations = []
+    pockets = max(int(100 * scale), 1)
+    for pocket in range(pockets):
+        x = (pocket % 10) * 30.0
+        y = (pocket // 10) * 30.0
+        commands = [Command("(Pocket%d)" % pocket), Command("M3", {"S": 12000}), Command("G0", {"Z": 5.0})]
+        for depth in (-0.5, -1.0, -1.5, -2.0, -2.5):
+            for ring in range(1, 11):
+                radius = ring * 1.2
+                commands.append(Command("G0", {"X": x + radius, "Y": y}))
+                commands.append(Command("G1", {"Z": depth, "F": 5.0}))
+                arc = "G2" if ring % 2 else "G3"
+                commands.append(Command(arc, {"X": x + radius, "Y": y, "I": -radius, "J": 0.0, "F": 15.0}))
+                commands.append(Command("G0", {"Z": 2.0}))
+        commands.append(Command("M5"))
+        operations.append(Operation("Pocket%d" % pocket, commands))
+    return operations
+
+
+def drillingJob(scale):
+    '''A grid of holes, drilled with G81, G82 and G83 in shuffled order.'''
+    from Path import Command  # pylint: disable=import-outside-toplevel
+    side = max(int(100 * math.sqrt(scale)), 2)
+    holes = [(x * 3.0, y * 3.0) for x in range(side) for y in range(side)]
+    random.Random(1).shuffle(holes)
+    operations = []
+    for name, cycle, extra in (("G81", "G81", {}), ("G82", "G82", {"P": 0.2}), ("G83", "G83", {"Q": 1.0})):
+        commands = [Command("M3", {"S": 10000}), Command("G0", {"Z": 5.0})]
+        for x, y in holes:
+            params = {"X": x, "Y": y, "Z": -3.0, "R": 2.0, "F": 3.0}
+            params.update(extra)
+            commands.append(Command(cycle, params))
+        commands.append(Command("G80"))
+        commands.append(Command("M5"))
+        operations.append(Operation("Drill" + name, commands))
+    return operations
+
+
+def freecadDrillingJob(scale):
+    '''The grid of drillingJob as FreeCAD's drilling operation emits it, a G0 X Y and G0 Z before every cycle.'''
+    from Path import Command  # pylint: disable=import-outside-toplevel
+    side = max(int(100 * math.sqrt(scale)), 2)
+    holes = [(x * 3.0, y * 3.0) for x in range(side) for y in range(side)]
+    random.Random(1).shuffle(holes)
+    operations = []
+    for name, cycle, extra in (("G81", "G81", {}), ("G82", "G82", {"P": 0.2}), ("G83", "G83", {"Q": 1.0})):
+        commands = [Command("(Drill%s)" % name), Command("M3", {"S": 10000}), Command("G0", {"Z": 10.0})]
+        for x, y in holes:
+            commands.append(Command("G0", {"X": x, "Y": y}))
+            commands.append(Command("G0", {"Z": 2.0}))
+            params = {"X": x, "Y": y, "Z": -3.0, "R": 2.0, "F": 3.0}
+            params.update(extra)
+            commands.append(Command(cycle, params))
+        commands.append(Command("G80"))
+        commands.append(Command("G0", {"Z": 10.0}))
+        commands.append(Command("M5"))
+        operations.append(Operation("FreeCADDrill" + name, commands))
+    return operations
+
+
+def nestedJob(scale):
+    '''Operations inside compounds nested 200 levels deep.'''
+    from Path import Command  # pylint: disable=import-outside-toplevel
+    levels = 200
+    segments = max(int(500 * scale), 1)
+    group = []
+    for level in range(levels, 0, -1):
+        commands = [Command("G0", {"X": 0.0, "Y": level * 1.0, "Z": 2.0}), Command("G1", {"Z": -1.0, "F": 5.0})]
+        for i in range(segments):
+            commands.append(Command("G1", {"X": (i + 1) * 0.2, "Y": level + 0.5 * math.sin(i / 5), "F": 15.0}))
+        commands.append(Command("G0", {"Z": 2.0}))
+        group = [Operation("Leaf%d" % level, commands), Operation("Compound%d" % level, group=group)]
+    return [Operation("Compound0", group=group)]
+
+
+def adaptiveJob(scale):
+    '''Trochoidal clearing of 1M short G1 segments with some small arcs, like adaptive paths.'''
+    from Path import Command  # pylint: disable=import-outside-toplevel
+    segments = max(int(1000000 * scale), 100)
+    perOperation = 100000
+    operations = []
+    step = 0.05  # mm the trochoid advances per segment
+    for first in range(0, segments, perOperation):
+        count = min(perOperation, segments - first)
+        row = first // perOperation
+        commands = [Command("M3", {"S": 18000}), Command("G0", {"X": 0.0, "Y": row * 10.0, "Z": 2.0}), Command("G1", {"Z": -1.0, "F": 8.0})]
+        for i in range(count):
+            angle = i * 0.3
+            x = i * step * 0.1 + 2.0 * math.cos(angle)
+            y = row * 10.0 + 2.0 * math.sin(angle)
+            if i % 50 == 49:
+                commands.append(Command("G3", {"X": x, "Y": y, "I": 0.5, "J": 0.5, "F": 20.0}))
+            else:
+                commands.append(Command("G1", {"X": x, "Y": y, "F": 20.0}))
+        commands.append(Command("G0", {"Z": 2.0}))
+        commands.append(Command("M5"))
+        operations.append(Operation("Adaptive%d" % row, commands))
+    return operations
+
+
+JOBS = {
+    "arcs": arcsJob,
+    "drilling": drillingJob,
+    "freecad-drilling": freecadDrillingJob,
+    "nested": nestedJob,
+    "adaptive": adaptiveJob,
+}
+
+
+def countCommands(operations):
+    count = 0
+    pending = list(operations)
+    while pending:
+        operation = pending.pop()
+        count += len(operation.Path.Commands)
+        pending.extend(getattr(operation, "Group", ()))
+    return count
+
+
+def peakMegabytes():
+    '''Peak resident memory of this process in MB, None where unknown.'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+def runCase(jobName, options, scale, freecadLib=None):
+    '''Posts one job with the options in this process, returns the result row.'''
+    post = importPost(freecadLib)
+    operations = JOBS[jobName](scale)
+    before = peakMegabytes()
+
+    with tempfile.TemporaryDirectory(prefix="snapmaker-benchmark-") as directory:
+        # never reuse a cached preview or operation
+        post.THUMBNAIL_CACHE_DIR = directory
+        post.OPERATION_CACHE_DIR = directory
+        output = os.path.join(directory, "job.cnc")
+        profile = os.path.join(directory, "profile.json")
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):
+            result = post.export(operations, output, options + " --no-show-editor --profile-json " + profile)
+        seconds = time.perf_counter() - started
+        if result is None:
+            raise RuntimeError("posting failed with %r" % options)
+        with open(profile) as profileFile:
+            stages = json.load(profileFile)
+
+    peak = peakMegabytes()
+    lines = stages["counts"]["lines"]
+    return {
+        "job": jobName,
+        "commands": countCommands(operations),
+        "lines": lines,
+        "bytes": stages["counts"]["bytes"],
+        "seconds": round(seconds, 3),
+        "lines_per_s": round(lines / seconds),
+        "peak_mb": None if peak is None else round(peak, 1),
+        "post_mb": None if peak is None else round(peak - before, 1),
+        "stages": {stage: round(value, 3) for stage, value in stages["seconds"].items()},
+    }
+
+
+def spawnCase(jobName, optionName, options, scale, freecadLib):
+    '''Runs the case in a fresh interpreter so peak memory is its own.'''
+    command = [sys.executable, os.path.abspath(__file__), "--case", jobName, "--case-options=" + options, "--scale", str(scale)]
+    if freecadLib:
+        command += ["--freecad-lib", freecadLib]
+    finished = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if finished.returncode != 0:
+        lines = finished.stderr.strip().splitlines()
+        return {"job": jobName, "options": optionName, "error": lines[-1] if lines else "exit code %d" % finished.returncode}
+    row = json.loads(finished.stdout)
+    row["options"] = optionName
+    return row
+
+
+def regressions(rows, baseline, tolerance):
+    '''(job, options, message) for the cases that got worse than the baseline.'''
+    previous = {(row["job"], row["options"]): row for row in baseline if not row.get("error")}
+    found = []
+    for row in rows:
+        old = previous.get((row["job"], row["options"]))
+        if old is None or row.get("error"):
+            continue
+        if row["lines_per_s"] < old["lines_per_s"] * (1 - tolerance):
+            found.append((row["job"], row["options"], "lines/s %d -> %d" % (old["lines_per_s"], row["lines_per_s"])))
+        if row["post_mb"] is not None and old["post_mb"] is not None and row["post_mb"] > max(old["post_mb"], 1.0) * (1 + tolerance):
+            found.append((row["job"], row["options"], "memory %.1f -> %.1f MB" % (old["post_mb"], row["post_mb"])))
+        if row["bytes"] > old["bytes"] * (1 + tolerance):
+            found.append((row["job"], row["options"], "output %d -> %d bytes" % (old["bytes"], row["bytes"])))
+    return found
+
+
+def printResults(rows):
+    widths = [max(len(column), *(len(str(row.get(column, ""))) for row in rows)) for column in RESULT_COLUMNS]
+    print("  ".join(column.ljust(width) for column, width in zip(RESULT_COLUMNS, widths)))
+    for row in rows:
+        if row.get("error"):
+            print("%s  %s  error: %s" % (row["job"], row["options"], row["error"]))
+            continue
+        print("  ".join(str(row.get(column, "")).ljust(width) for column, width in zip(RESULT_COLUMNS, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='benchmark_post', description='benchmark the FreeCAD post on synthetic jobs')
+    parser.add_argument('--jobs', nargs='+', choices=sorted(JOBS), default=list(JOBS), help='jobs to post, default: all')
+    parser.add_argument('--options', nargs='+', metavar='NAME=ARGS', help='post options to compare, default: ' + ", ".join(OPTIONS))
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the fastest one counts, default: 3')
+    parser.add_argument('--scale', type=float, default=1.0, help='size of the jobs, 1.0 posts about 1M segments for adaptive')
+    parser.add_argument('--json', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results of an earlier --json run')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative change against --baseline, default: %s' % TOLERANCE)
+    parser.add_argument('--freecad-lib', help='directory containing FreeCAD.so/FreeCAD.pyd, default: the stand-ins if FreeCAD can\'t be imported')
+    # a single case in this process, run by spawnCase()
+    parser.add_argument('--case', choices=sorted(JOBS), help=argparse.SUPPRESS)
+    parser.add_argument('--case-options', default="", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(runCase(args.case, args.case_options, args.scale, args.freecad_lib)))
+        return 0
+
+    options = OPTIONS
+    if args.options:
+        options = dict(option.partition('=')[::2] for option in args.options)
+
+    rows = []
+    for jobName in args.jobs:
+        for optionName, optionArgs in options.items():
+            runs = [spawnCase(jobName, optionName, optionArgs, args.scale, args.freecad_lib) for _ in range(max(args.repeat, 1))]
+            failed = [run for run in runs if run.get("error")]
+            rows.append(failed[0] if failed else max(runs, key=lambda run: run["lines_per_s"]))
+    printResults(rows)
+
+    if args.json:
+        with open(args.json, "w") as jsonFile:
+            json.dump(rows, jsonFile, indent=2)
+
+    failed = any(row.get("error") for row in rows)
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            found = regressions(rows, json.load(baselineFile), args.tolerance)
+        for job, optionName, message in found:
+            print("regression %s %s: %s" % (job, optionName, message))
+        failed = failed or bool(found)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
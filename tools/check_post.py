@@ -0,0 +1,104 @@
+'''Equivalence checks of the FreeCAD post on the synthetic jobs of benchmark_post.py.
+
+The post writes the same program
+- with --threads as without,
+- from the operation cache, cold and warm, as with --no-cache,
+- with emitToolpath() from a --toolpath recording as when posting.
+
+Every job is posted with every set of options and the programs are
+compared, apart from the output time:
+
+    python check_post.py
+    python check_post.py --jobs adaptive --options "" "--simplify 0.01"
+
+Without FreeCAD on the Python path the stand-ins in freecad_stand_ins/ are
+used. The exit code is 1 if any program differs.
+'''
+import argparse
+import contextlib
+import difflib
+import io
+import os
+import sys
+import tempfile
+
+import benchmark_post
+
+# post options every job is checked with
+OPTIONS = [
+    "",
+    "--line-numbers",
+    "--modal --axis-modal --trim-zeros",
+    "--rapids --order-holes --order-contours",
+    "--simplify 0.01 --estimate-acceleration",
+]
+
+OUTPUT_TIME = ";Output Time:"  # the only line that differs between runs
+
+DIFF_LINES = 20  # lines of a difference printed
+
+
+def programLines(text, args):
+    if text is None:
+        raise RuntimeError("posting failed with %r" % args)
+    return [line for line in text.splitlines() if OUTPUT_TIME not in line]
+
+
+def post(module, operations, args):
+    '''Lines of the program of the operations posted with args.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return programLines(module.export(operations, '-', args), args)
+
+
+def emit(module, path, args):
+    '''Lines of the program emitted from the toolpath at path with args.'''
+    with contextlib.redirect_stdout(io.StringIO()):
+        return programLines(module.emitToolpath(path, '-', args), args)
+
+
+def same(name, expected, actual):
+    '''True if the programs are the same, else prints the first differences.'''
+    if expected == actual:
+        return True
+    diff = difflib.unified_diff(expected, actual, "posted", name, lineterm="")
+    print("\n".join(list(diff)[:DIFF_LINES]))
+    return False
+
+
+def checkJob(module, jobName, options, scale):
+    '''(check, passed) of every check of the job posted with the options.'''
+    operations = benchmark_post.JOBS[jobName](scale)
+    args = options + " --no-show-editor"
+    with tempfile.TemporaryDirectory(prefix="snapmaker-check-") as directory:
+        module.THUMBNAIL_CACHE_DIR = os.path.join(directory, "thumbnails")
+        module.OPERATION_CACHE_DIR = os.path.join(directory, "operations")
+        expected = post(module, operations, args + " --no-cache")
+        checks = [("threads", same("--threads 4", expected, post(module, operations, args + " --no-cache --threads 4")))]
+        checks.append(("cold cache", same("cold cache", expected, post(module, operations, args))))
+        checks.append(("warm cache", same("warm cache", expected, post(module, operations, args))))
+        toolpath = os.path.join(directory, "toolpath.npy")
+        post(module, operations, args + " --no-cache --toolpath " + toolpath)
+        checks.append(("toolpath", same("emitToolpath", expected, emit(module, toolpath, args + " --no-cache"))))
+    return checks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='check_post', description='check the FreeCAD post writes the same program with threads, the cache and emitToolpath()')
+    parser.add_argument('--jobs', nargs='+', choices=sorted(benchmark_post.JOBS), default=list(benchmark_post.JOBS), help='jobs to post, default: all')
+    parser.add_argument('--options', nargs='+', metavar='ARGS', help='post options to check with, default: ' + ", ".join(repr(options) for options in OPTIONS))
+    parser.add_argument('--scale', type=float, default=0.05, help='size of the jobs, see benchmark_post.py, default: 0.05')
+    parser.add_argument('--freecad-lib', help='directory containing FreeCAD.so/FreeCAD.pyd, default: the stand-ins if FreeCAD can\'t be imported')
+    args = parser.parse_args(argv)
+
+    module = benchmark_post.importPost(args.freecad_lib)
+    failed = False
+    for jobName in args.jobs:
+        for options in args.options or OPTIONS:
+            for check, passed in checkJob(module, jobName, options, args.scale):
+                print("%-18s %-45s %-12s %s" % (jobName, repr(options), check, "ok" if passed else "DIFFERS"))
+                failed = failed or not passed
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
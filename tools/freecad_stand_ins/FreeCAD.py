@@ -0,0 +1,43 @@
+'''Stand-in for the FreeCAD module, see README.md.'''
+import math
+
+GuiUp = False
+
+
+class Vector:
+    def __init__(self, x=0.0, y=0.0, z=0.0):
+        if isinstance(x, Vector):
+            x, y, z = x.x, x.y, x.z
+        self.x = float(x)
+        self.y = float(y)
+        self.z = float(z)
+
+    def __add__(self, other):
+        return Vector(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Vector(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    @property
+    def Length(self):
+        return math.sqrt(self.x * self.x + self.y * self.y + self.z * self.z)
+
+    def __repr__(self):
+        return "Vector (%r, %r, %r)" % (self.x, self.y, self.z)
+
+
+class Units:
+    Velocity = "Velocity"
+
+    class Quantity:
+        '''Only velocities given in mm/s, as in Path commands.'''
+
+        def __init__(self, value, unit=None):
+            self.value = float(value)
+
+        def getValueAs(self, unit):
+            if unit == 'mm/min':
+                return self.value * 60
+            if unit == 'in/min':
+                return self.value * 60 / 25.4
+            raise ValueError("unsupported unit %s" % unit)
@@ -0,0 +1,54 @@
+'''Stand-in for Path.Geom, see ../README.md.'''
+import math
+
+from FreeCAD import Vector
+
+Tolerance = 0.0000001
+
+
+def isRoughly(float1, float2, error=Tolerance):
+    return math.fabs(float1 - float2) <= error
+
+
+def pointsCoincide(p1, p2, error=Tolerance):
+    return isRoughly(p1.x, p2.x, error) and isRoughly(p1.y, p2.y, error) and isRoughly(p1.z, p2.z, error)
+
+
+class Edge:
+    '''A line or helix given by its point at t in [0, 1].'''
+
+    def __init__(self, pointAt, length):
+        self.pointAt = pointAt
+        self.Length = length
+
+    def copy(self):
+        return self
+
+    def discretize(self, count):
+        return [self.pointAt(i / (count - 1)) for i in range(count)]
+
+
+def edgeForCmd(cmd, startPoint):
+    '''The edge of a G0-G3 command starting at startPoint, None for anything else.'''
+    params = cmd.Parameters
+    start = Vector(startPoint)
+    end = Vector(params.get('X', start.x), params.get('Y', start.y), params.get('Z', start.z))
+    if cmd.Name in ('G0', 'G00', 'G1', 'G01'):
+        delta = end - start
+        if pointsCoincide(start, end):
+            return None
+        return Edge(lambda t: Vector(start.x + delta.x * t, start.y + delta.y * t, start.z + delta.z * t), delta.Length)
+    if cmd.Name in ('G2', 'G02', 'G3', 'G03'):
+        cx = start.x + params.get('I', 0)
+        cy = start.y + params.get('J', 0)
+        radius = math.hypot(start.x - cx, start.y - cy)
+        startAngle = math.atan2(start.y - cy, start.x - cx)
+        endAngle = math.atan2(end.y - cy, end.x - cx)
+        if cmd.Name in ('G3', 'G03'):
+            sweep = (endAngle - startAngle) % (2 * math.pi) or 2 * math.pi
+        else:
+            sweep = -((startAngle - endAngle) % (2 * math.pi) or 2 * math.pi)
+        dz = end.z - start.z
+        return Edge(lambda t: Vector(cx + radius * math.cos(startAngle + sweep * t), cy + radius * math.sin(startAngle + sweep * t), start.z + dz * t),
+                    math.hypot(radius * sweep, dz))
+    return None
@@ -0,0 +1,43 @@
+'''Stand-in for Path.Log, messages go to stderr, see ../README.md.'''
+import sys
+
+
+class Level:
+    RESET = -1
+    ERROR = 0
+    WARNING = 1
+    NOTICE = 2
+    INFO = 3
+    DEBUG = 4
+
+
+_levels = {}
+
+
+def thisModule():
+    return sys._getframe(1).f_globals.get("__name__")
+
+
+def setLevel(level, module=None):
+    _levels[module] = level
+
+
+def getLevel(module=None):
+    return _levels.get(module, Level.NOTICE)
+
+
+def _log(level, module, message):
+    if getLevel(module) >= level:
+        sys.stderr.write("%s: %s\n" % (module, message))
+
+
+def debug(message):
+    _log(Level.DEBUG, thisModule(), message)
+
+
+def warning(message):
+    _log(Level.WARNING, thisModule(), message)
+
+
+def error(message):
+    _log(Level.ERROR, thisModule(), message)
@@ -0,0 +1,8 @@
+'''Stand-in for Path.Post.Utils, see ../../README.md.'''
+
+
+class GCodeEditorDialog:
+    '''Never shown, FreeCAD.GuiUp is False.'''
+
+    def __init__(self):
+        raise RuntimeError("no GUI in the FreeCAD stand-ins")
@@ -0,0 +1,17 @@
+'''Stand-in for FreeCAD's Path module, see ../README.md.'''
+
+
+class Command:
+    __slots__ = ("Name", "Parameters")
+
+    def __init__(self, name, parameters=None):
+        self.Name = name
+        self.Parameters = dict(parameters or {})
+
+    def __repr__(self):
+        return "Command %s [%s]" % (self.Name, " ".join("%s:%s" % item for item in self.Parameters.items()))
+
+
+class Path:
+    def __init__(self, commands=()):
+        self.Commands = list(commands)
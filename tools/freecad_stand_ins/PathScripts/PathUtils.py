@@ -0,0 +1,6 @@
+'''Stand-in for PathScripts.PathUtils, see ../README.md.'''
+
+
+def findParentJob(obj):
+    '''Synthetic operations have no job, the post then uses its defaults.'''
+    return None
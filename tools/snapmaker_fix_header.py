@@ -0,0 +1,171 @@
+'''Rewrites the ;Header Start ... ;Header End block of Snapmaker 2 CNC G-code.
+
+Aspire and ArtCAM output often lacks the boundary, file_total_lines or
+thumbnail fields, or carries values that don't match the toolpath. The body
+is read once to compute the header (see snapmaker_gcode.py), then the new
+header is written followed by the untouched body, which is copied file to
+file by the kernel (copy_file_range or sendfile) where available:
+
+    python snapmaker_fix_header.py --thumbnail preview.png part.cnc
+
+Files are replaced in place unless --output is given. Existing header fields
+keep their order, computed fields that are missing are added.
+'''
+import argparse
+import base64
+import mmap
+import os
+import shutil
+import sys
+import tempfile
+
+import snapmaker_gcode
+
+COPY_CHUNK = 1 << 30  # bytes per copy_file_range/sendfile call
+
+# header written to files that don't have one
+NEW_HEADER = [";Header Start\n", ";header_type: cnc\n", ";Header End\n"]
+
+
+def copyRange(source, target, offset, count):
+    '''Copies count bytes from offset of source to the end of target.'''
+    end = offset + count
+    for method in ("copy_file_range", "sendfile"):
+        copy = getattr(os, method, None)
+        if copy is None:
+            continue
+        try:
+            while offset < end:
+                if method == "copy_file_range":
+                    copied = copy(source.fileno(), target.fileno(), min(COPY_CHUNK, end - offset), offset)
+                else:
+                    copied = copy(target.fileno(), source.fileno(), offset, min(COPY_CHUNK, end - offset))
+                if copied == 0:
+                    break
+                offset += copied
+            if offset >= end:
+                return
+        except OSError:
+            # not supported between these files (e.g. across file systems), try the next method
+            target.seek(0, os.SEEK_END)
+    source.seek(offset)
+    while offset < end:
+        data = source.read(min(1 << 20, end - offset))
+        if not data:
+            break
+        target.write(data)
+        offset += len(data)
+
+
+def findHeader(mapped):
+    '''Byte offsets (start, end) of the header lines, None without header.'''
+    start = mapped.find(b';Header Start')
+    if start < 0:
+        return None
+    end = mapped.find(b';Header End', start)
+    if end < 0:
+        return None
+    start = mapped.rfind(b'\n', 0, start) + 1
+    lineEnd = mapped.find(b'\n', end)
+    return start, len(mapped) if lineEnd < 0 else lineEnd + 1
+
+
+def headerFields(report, thumbnail=None):
+    '''The computed header values of an analyzed file, file_total_lines is a placeholder.'''
+    fields = {}
+    if thumbnail is not None:
+        fields["thumbnail"] = "data:image/png;base64," + thumbnail
+    fields["file_total_lines"] = "0"
+    fields["estimated_time(s)"] = format(report["estimated_time_s"], '.1f')
+    if report["boundary"] is not None:
+        for field, value in report["boundary"].items():
+            fields[field] = format(value, '.3f')
+    return fields
+
+
+def headerLines(existing, fields):
+    '''Header lines with the fields replaced, missing fields added before ;Header End.'''
+    lines = []
+    done = set()
+    for line in existing[:-1]:
+        key, sep, _ = line.lstrip(';').partition(':')
+        key = key.strip()
+        if line.startswith(';') and sep and key in fields:
+            line = ";%s: %s\n" % (key, fields[key])
+            done.add(key)
+        lines.append(line)
+    for key, value in fields.items():
+        if key not in done:
+            lines.append(";%s: %s\n" % (key, value))
+    lines.append(existing[-1])
+    return lines
+
+
+def fixHeader(path, output=None, thumbnail=None):
+    '''Writes path with a recomputed header to output (default: path). Returns the analysis report.'''
+    report = snapmaker_gcode.analyze(path)
+    if thumbnail is not None:
+        with open(thumbnail, "rb") as image:
+            thumbnail = base64.b64encode(image.read()).decode()
+    fields = headerFields(report, thumbnail)
+
+    with open(path, "rb") as source:
+        size = os.fstat(source.fileno()).st_size
+        found = None
+        if size:
+            with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                found = findHeader(mapped)
+                if found is not None:
+                    prefix = mapped[:found[0]]
+                    existing = mapped[found[0]:found[1]].decode('utf-8', 'replace').splitlines(True)
+                    if not existing[-1].endswith("\n"):
+                        existing[-1] += "\n"
+                    bodyStart = found[1]
+        if found is None:
+            prefix = b""
+            existing = NEW_HEADER
+            bodyStart = 0
+
+        # the header keeps its number of lines whatever the value is
+        lines = headerLines(existing, fields)
+        bodyLines = report["lines"] - (report["header_lines"] if found is not None else 0)
+        fields["file_total_lines"] = str(prefix.count(b"\n") + len(lines) + bodyLines)
+        header = "".join(headerLines(existing, fields)).encode('utf-8')
+
+        target = output or path
+        directory = os.path.dirname(os.path.abspath(target))
+        with tempfile.NamedTemporaryFile(dir=directory, prefix=".snapmaker-", delete=False) as temporary:
+            try:
+                temporary.write(prefix)
+                temporary.write(header)
+                temporary.flush()
+                copyRange(source, temporary, bodyStart, size - bodyStart)
+            except BaseException:
+                os.unlink(temporary.name)
+                raise
+    if os.path.exists(target):
+        shutil.copymode(target, temporary.name)
+    os.replace(temporary.name, target)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='snapmaker_fix_header', description='recompute the header of Snapmaker 2 CNC G-code files')
+    parser.add_argument('files', nargs='+', help='G-code files, rewritten in place')
+    parser.add_argument('--output', help='write the result here instead, only for a single file')
+    parser.add_argument('--thumbnail', help='PNG image embedded as thumbnail')
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.files) > 1:
+        parser.error("--output takes a single file")
+    for path in args.files:
+        report = fixHeader(path, args.output, args.thumbnail)
+        fixed = ", ".join(field for field, _, _ in report["header_mismatches"]) or "nothing"
+        if not report["header"]:
+            fixed = "added header"
+        print("%s: fixed %s" % (args.output or path, fixed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
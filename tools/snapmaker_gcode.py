@@ -0,0 +1,323 @@
+'''Streaming reader and analyzer for Snapmaker 2 CNC G-code.
+
+Reads the dialect described in gcode_reference.md (G0/G1, G4, M3 P, M5 and
+the ;Header Start ... ;Header End block) as written by Luban, Fusion 360,
+ArtCAM, Aspire and the FreeCAD post. Files are memory mapped and read line
+by line, moves are collected in blocks of typed arrays, so files of
+millions of lines are analyzed without building a Python object per move.
+
+    python snapmaker_gcode.py luban_3.1.0_snapamker_text.cnc
+    python snapmaker_gcode.py --json part1.cnc part2.cnc
+
+Only pure Python modules are used, the tool runs without FreeCAD or NumPy.
+'''
+import argparse
+import json
+import math
+import mmap
+import re
+import sys
+from array import array
+
+# Move kinds of a MoveBlock
+MOVE_TRAVEL = 0  # G0
+MOVE_CUT = 1  # G1
+
+MOVE_BLOCK_SIZE = 65536  # moves per MoveBlock
+
+MM_PER_INCH = 25.4
+
+BOUNDARY_FIELDS = ["max_x(mm)", "max_y(mm)", "max_z(mm)", "min_x(mm)", "min_y(mm)", "min_z(mm)"]
+
+# Allowed difference between header values and the values found in the body
+BOUNDARY_TOLERANCE = 0.01  # mm
+TIME_TOLERANCE = 0.1  # relative
+
+# Commands of the dialect, everything else is counted as unsupported
+DIALECT = {'G0', 'G1', 'G4', 'M3', 'M5'}
+AXES = ((0, b'X'), (1, b'Y'), (2, b'Z'))
+
+WORD = re.compile(rb'([A-Za-z])\s*([-+]?(?:\d+\.?\d*|\.\d+))')
+
+
+def readLines(path):
+    '''Yields the lines of the file as bytes, memory mapped where possible.'''
+    with open(path, "rb") as gfile:
+        try:
+            mapped = mmap.mmap(gfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty files can't be mapped
+            return
+        with mapped:
+            yield from iter(mapped.readline, b"")
+
+
+class MoveBlock:
+    '''Up to MOVE_BLOCK_SIZE moves as parallel typed arrays.
+
+    Every move is stored with its kind, its end point and feedrate in mm and
+    mm/min and the number of the line it was read from.
+    '''
+
+    def __init__(self):
+        self.kind = array('B')
+        self.x = array('d')
+        self.y = array('d')
+        self.z = array('d')
+        self.f = array('d')
+        self.line = array('L')
+
+    def __len__(self):
+        return len(self.kind)
+
+    def append(self, kind, x, y, z, f, line):
+        self.kind.append(kind)
+        self.x.append(x)
+        self.y.append(y)
+        self.z.append(z)
+        self.f.append(f)
+        self.line.append(line)
+
+
+class GCodeParser:
+    '''Modal state of the machine while a file is read.
+
+    moves() yields the moves of the file in MoveBlocks. Everything else the
+    parser meets on the way (header fields, dwell time, spindle power and
+    commands outside the dialect) is kept on the parser.
+    '''
+
+    def __init__(self, start=(0.0, 0.0, 0.0)):
+        self.position = list(start)
+        self.start = tuple(start)
+        self.feedrate = 0.0
+        self.motion = None  # last G0/G1, coordinates without a command repeat it
+        self.relative = False
+        self.scale = 1.0  # G20 switches to inches
+        self.lines = 0
+        self.header = {}
+        self.headerLines = 0
+        self.dwell = 0.0
+        self.maxPower = 0.0
+        self.unsupported = {}
+        self.names = {}
+
+    def commandName(self, letter, value):
+        '''"G1" for the words G1, G01 or G1.0, memoized by the raw word.'''
+        key = letter + value
+        name = self.names.get(key)
+        if name is None:
+            name = self.names[key] = letter.decode() + str(int(float(value)))
+        return name
+
+    def moves(self, path, blockSize=MOVE_BLOCK_SIZE):
+        block = MoveBlock()
+        count = 0
+        inHeader = False
+        position = self.position
+        self.names = {}
+        for raw in readLines(path):
+            self.lines += 1
+            code, _, comment = raw.partition(b';')
+            if comment:
+                comment = comment.strip()
+                if comment == b'Header Start':
+                    inHeader = True
+                elif comment == b'Header End':
+                    inHeader = False
+                    self.headerLines = self.lines
+                elif inHeader:
+                    key, sep, value = comment.partition(b':')
+                    if sep:
+                        self.header[key.strip().decode('utf-8', 'replace')] = value.strip().decode('utf-8', 'replace')
+            if b'(' in code:
+                code = code.partition(b'(')[0]
+
+            command = None
+            params = {}
+            for letter, value in WORD.findall(code.upper()):
+                if letter == b'G' or letter == b'M':
+                    name = self.commandName(letter, value)
+                    if name in DIALECT:
+                        command = name
+                    elif name == 'G90':
+                        self.relative = False
+                    elif name == 'G91':
+                        self.relative = True
+                    elif name == 'G20':
+                        self.scale = MM_PER_INCH
+                    elif name == 'G21':
+                        self.scale = 1.0
+                    else:
+                        self.unsupported[name] = self.unsupported.get(name, 0) + 1
+                elif letter != b'N':
+                    params[letter] = float(value)
+            if not params and command is None:
+                continue
+
+            if command is None and self.motion is not None and (b'X' in params or b'Y' in params or b'Z' in params):
+                command = self.motion
+            if command == 'G0' or command == 'G1':
+                self.motion = command
+                if b'F' in params:
+                    self.feedrate = params[b'F'] * self.scale
+                for axis, letter in AXES:
+                    if letter in params:
+                        value = params[letter] * self.scale
+                        position[axis] = position[axis] + value if self.relative else value
+                block.append(MOVE_CUT if command == 'G1' else MOVE_TRAVEL,
+                             position[0], position[1], position[2], self.feedrate, self.lines)
+                count += 1
+                if count >= blockSize:
+                    yield block
+                    block = MoveBlock()
+                    count = 0
+            elif command == 'G4':
+                if b'P' in params:
+                    self.dwell += params[b'P'] / 1000
+                elif b'S' in params:
+                    self.dwell += params[b'S']
+            elif command == 'M3':
+                self.maxPower = max(self.maxPower, params.get(b'P', 100.0))
+        if count:
+            yield block
+
+
+class GCodeStats:
+    '''Totals of a move stream: bounds, travel and cut distance, time.'''
+
+    def __init__(self, start=(0.0, 0.0, 0.0)):
+        self.position = tuple(start)
+        self.minimum = [math.inf] * 3
+        self.maximum = [-math.inf] * 3
+        self.moves = 0
+        self.travel = 0.0
+        self.cut = 0.0
+        self.seconds = 0.0
+        self.maxFeedrate = 0.0
+        self.withoutFeedrate = 0  # moves that can't be timed
+
+    def add(self, block):
+        lx, ly, lz = self.position
+        minimum = self.minimum
+        maximum = self.maximum
+        travel = cut = seconds = 0.0
+        for kind, x, y, z, f in zip(block.kind, block.x, block.y, block.z, block.f):
+            length = math.sqrt((x - lx) ** 2 + (y - ly) ** 2 + (z - lz) ** 2)
+            if kind == MOVE_CUT:
+                cut += length
+            else:
+                travel += length
+            if f > 0:
+                seconds += length * 60 / f
+            elif length > 0:
+                self.withoutFeedrate += 1
+            lx, ly, lz = x, y, z
+        self.travel += travel
+        self.cut += cut
+        self.seconds += seconds
+        self.moves += len(block)
+        if len(block):
+            self.position = (lx, ly, lz)
+            for axis, values in enumerate((block.x, block.y, block.z)):
+                minimum[axis] = min(minimum[axis], min(values))
+                maximum[axis] = max(maximum[axis], max(values))
+            self.maxFeedrate = max(self.maxFeedrate, max(block.f))
+
+    def boundary(self):
+        '''Bounds keyed by BOUNDARY_FIELDS, None for files without moves.'''
+        if not self.moves:
+            return None
+        values = self.maximum + self.minimum
+        return dict(zip(BOUNDARY_FIELDS, values))
+
+
+def headerMismatches(header, lines, boundary, seconds):
+    '''Header fields that disagree with the body as (field, header, body) tuples.'''
+    mismatches = []
+
+    def number(field):
+        try:
+            return float(header[field])
+        except (KeyError, ValueError):
+            return None
+
+    # Luban also counts the empty line after the last line break
+    expected = number("file_total_lines")
+    if expected is not None and not 0 <= int(expected) - lines <= 1:
+        mismatches.append(("file_total_lines", header["file_total_lines"], lines))
+    if boundary is not None:
+        for field in BOUNDARY_FIELDS:
+            value = number(field)
+            if value is not None and abs(value - boundary[field]) > BOUNDARY_TOLERANCE:
+                mismatches.append((field, header[field], round(boundary[field], 3)))
+    expected = number("estimated_time(s)")
+    if expected is not None and abs(expected - seconds) > TIME_TOLERANCE * max(expected, seconds):
+        mismatches.append(("estimated_time(s)", header["estimated_time(s)"], round(seconds, 1)))
+    for field in ("file_total_lines", "estimated_time(s)") + tuple(BOUNDARY_FIELDS):
+        if header and field not in header:
+            mismatches.append((field, None, "missing"))
+    return mismatches
+
+
+def analyze(path, blockSize=MOVE_BLOCK_SIZE):
+    '''Reads the file once and returns its report as a dict.'''
+    parser = GCodeParser()
+    stats = GCodeStats(parser.start)
+    for block in parser.moves(path, blockSize):
+        stats.add(block)
+    seconds = stats.seconds + parser.dwell
+    boundary = stats.boundary()
+    return {
+        "file": path,
+        "lines": parser.lines,
+        "header_lines": parser.headerLines,
+        "moves": stats.moves,
+        "travel_mm": round(stats.travel, 3),
+        "cut_mm": round(stats.cut, 3),
+        "estimated_time_s": round(seconds, 1),
+        "dwell_s": round(parser.dwell, 3),
+        "max_feedrate": stats.maxFeedrate,
+        "moves_without_feedrate": stats.withoutFeedrate,
+        "max_spindle_power": parser.maxPower,
+        "boundary": None if boundary is None else {k: round(v, 3) for k, v in boundary.items()},
+        "unsupported_commands": parser.unsupported,
+        "header": {k: v for k, v in parser.header.items() if k != "thumbnail"},
+        "header_mismatches": headerMismatches(parser.header, parser.lines, boundary, seconds),
+    }
+
+
+def printReport(report):
+    print(report["file"])
+    print("  lines: %d (header: %d)" % (report["lines"], report["header_lines"]))
+    print("  moves: %d, travel: %.3f mm, cut: %.3f mm" % (report["moves"], report["travel_mm"], report["cut_mm"]))
+    print("  estimated time: %.1f s (dwell %.3f s)" % (report["estimated_time_s"], report["dwell_s"]))
+    print("  max feedrate: %g, max spindle power: %g%%" % (report["max_feedrate"], report["max_spindle_power"]))
+    if report["moves_without_feedrate"]:
+        print("  moves without feedrate: %d" % report["moves_without_feedrate"])
+    if report["boundary"]:
+        print("  boundary: " + ", ".join("%s %g" % item for item in report["boundary"].items()))
+    if report["unsupported_commands"]:
+        print("  commands outside the dialect: " + ", ".join("%s x%d" % item for item in sorted(report["unsupported_commands"].items())))
+    if not report["header"]:
+        print("  no header")
+    for field, header, body in report["header_mismatches"]:
+        print("  header %s: %s, body: %s" % (field, header, body))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='snapmaker_gcode', description='analyze Snapmaker 2 CNC G-code files')
+    parser.add_argument('files', nargs='+', help='G-code files (.cnc, .nc, .gcode)')
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    args = parser.parse_args(argv)
+
+    reports = [analyze(path) for path in args.files]
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for report in reports:
+            printReport(report)
+    return 1 if any(report["header_mismatches"] for report in reports) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())